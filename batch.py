@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import argparse
+import glob
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from blobstore import BlobStore, dump_to_store
+from save_data import KoikatuSaveData, dump_characters, iter_characters
+
+
+def find_save_files(patterns):
+    u"""expand directories and glob patterns to a sorted list of save files"""
+    files = []
+    for pattern in patterns:
+        if Path(pattern).is_dir():
+            files += sorted(Path(pattern).glob('*.dat'))
+        else:
+            files += sorted(Path(p) for p in glob.glob(pattern, recursive=True))
+    return files
+
+
+def extract(filename, outdir):
+    return dump_characters(iter_characters(filename, lazy=True), outdir)
+
+
+def extract_store(filename, outdir):
+    # blobs shared by all saves in outdir/../objects, a manifest per save
+    store = BlobStore(outdir.parent / 'objects')
+    manifest = outdir.parent / f'{outdir.name}.json'
+    return dump_to_store(iter_characters(filename, lazy=True), store, manifest, filename)
+
+
+def resave(filename, outdir):
+    # re-encode every character instead of copying the original bytes
+    save_data = KoikatuSaveData(filename)
+    for chara in save_data.characters:
+        chara.mark_dirty()
+    outdir.mkdir(parents=True, exist_ok=True)
+    save_data.save(outdir / Path(filename).name)
+    return len(save_data.characters)
+
+
+ACTIONS = {
+    'extract': extract,
+    'extract-store': extract_store,
+    'resave': resave,
+}
+
+
+def output_dirs(files, outdir, action):
+    # one directory per save for extraction, unique even for equal names
+    if not action.startswith('extract'):
+        return [outdir] * len(files)
+    dirs = []
+    used = set()
+    for filename in files:
+        name = filename.stem
+        n = 1
+        while name in used:
+            name = f'{filename.stem}_{n}'
+            n += 1
+        used.add(name)
+        dirs.append(outdir / name)
+    return dirs
+
+
+def run(files, action, outdir, workers=None, ordered=True):
+    u"""process save files in a process pool
+
+    Yields (filename, result, error) per file; a failing file is reported
+    with its error and does not stop the others.
+    """
+    func = ACTIONS[action]
+    dirs = output_dirs(files, Path(outdir), action)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, filename, d): filename
+                   for filename, d in zip(files, dirs)}
+        done = futures if ordered else as_completed(futures)
+        for future in done:
+            try:
+                yield (futures[future], future.result(), None)
+            except Exception as e:
+                yield (futures[future], None, e)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=sorted(ACTIONS))
+    parser.add_argument('paths', nargs='+',
+                        help='save files, directories or glob patterns')
+    parser.add_argument('-o', dest='outdir',
+                        help='output directory (default: cards or resaved)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: cpu count)')
+    parser.add_argument('--unordered', action='store_true',
+                        help='report results as soon as each file is done')
+
+    args = parser.parse_args()
+    outdir = args.outdir
+    if outdir is None:
+        outdir = 'cards' if args.action.startswith('extract') else 'resaved'
+
+    files = find_save_files(args.paths)
+    failed = 0
+    for filename, count, error in run(files, args.action, outdir,
+                                      args.workers, not args.unordered):
+        if error is None:
+            print(f'{filename}: {count} characters')
+        else:
+            print(f'{filename}: error: {error!r}', file=sys.stderr)
+            failed += 1
+
+    print(f'{len(files) - failed} of {len(files)} files done')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+import argparse
+import os
+import random
+import struct
+import tempfile
+import time
+import tracemalloc
+import zlib
+from pathlib import Path
+
+from character import AC_MAP, KoikatuCharacter
+from save_data import KoikatuSaveData
+
+VERSION = '1.0.2'
+ADDITIONAL_KEYS = ['Idle', 'Talk', 'Date', 'Lunch', 'Club', 'Study', 'Exercise']
+
+
+def make_png(width, height, seed=0):
+    u"""PNG of random pixels, which compresses about as badly as a portrait"""
+    rnd = random.Random(seed)
+    raw = b''.join(b'\x00' + rnd.getrandbits(width * 24).to_bytes(width * 3, 'little')
+                   for _ in range(height))
+    compressed = zlib.compress(raw)
+    data = [
+        b'\x89\x50\x4e\x47\x0d\x0a\x1a\x0a',
+        _png_chunk(b'IHDR', struct.pack('!IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+    ]
+    for i in range(0, len(compressed), 8192):
+        data.append(_png_chunk(b'IDAT', compressed[i:i + 8192]))
+    data.append(_png_chunk(b'IEND', b''))
+    return b''.join(data)
+
+
+def _png_chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack('!I', len(data)) + chunk_type + data + struct.pack('!I', crc)
+
+
+def make_character(index, png, outfits=3, kkex_size=0, player=False):
+    u"""KoikatuCharacter with plausible content, built without parsing"""
+    rnd = random.Random(index)
+    chara = KoikatuCharacter.__new__(KoikatuCharacter)
+    chara._changed = set()
+    chara._pending = {}
+    chara._raw = None
+    chara.offset = None
+    chara._views = {}
+    chara._blocks = {}
+    chara._handed_out = set()
+    chara.master_version = VERSION
+    chara.with_card = False
+
+    chara.product_no = 100
+    chara.marker = ('【KoiKatuChara】', 18)
+    chara.unknown01 = ('0.0.0', 5)
+    chara.png_length = len(png)
+    chara.png = png
+
+    chara.info_order = ['Custom', 'Coordinate', 'Parameter', 'Status']
+    if kkex_size:
+        chara.info_order.append('KKEx')
+    chara.list_info = {'lstInfo': [{'name': name, 'version': '0.0.0', 'pos': 0, 'size': 0}
+                                   for name in chara.info_order]}
+
+    chara.custom = (
+        {'version': '0.0.2', 'headId': index % 5,
+         'shapeValueFace': [rnd.random() for _ in range(52)]},
+        {'version': '0.0.2', 'shapeValueBody': [rnd.random() for _ in range(44)],
+         'skinMainColor': [1.0, 0.9, 0.8, 1.0]},
+        {'version': '0.0.4', 'kind': 0,
+         'parts': [{'id': i, 'baseColor': [0.2, 0.1, 0.1, 1.0], 'length': 0.5}
+                   for i in range(4)]},
+    )
+    chara.coordinates = [{
+        'clothes': {'version': '0.0.1',
+                    'parts': [{'id': rnd.randrange(100), 'colorInfo': [1.0] * 8}
+                              for _ in range(8)]},
+        'accessory': {'version': '0.0.1',
+                      'parts': [{'type': 120, 'id': 0, 'addMove': [0.0] * 9}
+                                for _ in range(20)]},
+        'enableMakeup': False,
+        'makeup': {'version': '0.0.1', 'eyeshadowColor': [0.5, 0.5, 0.5, 1.0]},
+    } for _ in range(outfits)]
+
+    sex = 0 if player else 1
+    chara.parameter = {
+        'version': '0.0.5', 'sex': sex,
+        'lastname': f'姓{index}', 'firstname': f'名{index}', 'nickname': f'nick{index}',
+        'personality': index % 38, 'weakPoint': index % 7, 'intelligence': 0,
+        'awnser': {key: rnd.random() < 0.5 for key in
+                   ('animal', 'eat', 'cook', 'exercise', 'study', 'fashionable',
+                    'blackCoffee', 'spicy', 'sweet')},
+        'denial': {key: rnd.random() < 0.5 for key in
+                   ('kiss', 'aibu', 'anal', 'massage', 'notCondom')},
+        'attribute': {key: rnd.random() < 0.3 for key in
+                      ('hinnyo', 'harapeko', 'donkan', 'choroi', 'bitch', 'mutturi',
+                       'dokusyo', 'ongaku', 'kappatu', 'ukemi', 'friendly')},
+    }
+    chara.status = {'version': '0.0.3', 'clothesState': b'\x00' * 9,
+                    'eyesBlink': True, 'mouthPtn': 0}
+    chara.kkex = {'plugin': [1, {'data': os.urandom(kkex_size)}]} if kkex_size else None
+
+    chara.ex_data = b''
+    chara.unknown02 = b'\x00' * 4
+    chara.unknown_mark = b'\x00' * 4
+    chara.dearname = ('', 0)
+    chara.feeling = rnd.randrange(100)
+    chara.m_love = rnd.randrange(100)
+    chara.h_count = rnd.randrange(10)
+    chara.koikatu = rnd.randrange(2)
+    chara.lover = rnd.randrange(2)
+    chara.anger = 0
+    chara.unknown03 = b'\x00'
+    chara.strength = 0
+    chara.date = 0
+    chara.ero = 0
+
+    chara.ac = {}
+    chara.additional_keys = []
+    chara.additional = {}
+    if player:
+        chara.unknown06 = b''
+        chara.unknown07 = b''
+        for key in ('mune', 'kokan', 'anal', 'siri', 'tikubi',
+                    'kokan_piston', 'anal_piston', 'houshi'):
+            chara.ac[key] = b''
+        chara.before_additional = b'\x00' * 64
+    else:
+        chara.unknown06 = b'\x00' * 14
+        chara.unknown07 = b'\x00' * 14
+        for key in ('mune', 'kokan', 'anal', 'siri', 'tikubi',
+                    'kokan_piston', 'anal_piston', 'houshi'):
+            chara.ac[key] = b'\x00\x00' + AC_MAP[rnd.randrange(len(AC_MAP))]
+        chara.before_additional = b'\x00' * 8
+        for key in ADDITIONAL_KEYS:
+            chara.additional_keys.append(key)
+            chara.additional[key] = rnd.randrange(1000)
+    chara.eventAfterDay = 0
+    chara.isFirstGirlfriend = 0
+    chara.intimacy = rnd.randrange(100)
+    chara.after_additional = b'\x00' * 16
+    return chara
+
+
+def make_save(filename, count, png_size=(252, 352), outfits=3, kkex_size=0):
+    u"""write a synthetic save with count characters, the first is the player"""
+    save_data = KoikatuSaveData.__new__(KoikatuSaveData)
+    save_data.filename = str(filename)
+    save_data.lazy = False
+    save_data.workers = None
+    save_data.progress = None
+    save_data._mmap = None
+    save_data._buffer = None
+    save_data._stat = None
+    save_data.b_version = VERSION.encode()
+    save_data.version_length = bytes([len(save_data.b_version)])
+    save_data.version_num = VERSION
+    save_data.school = ('bench', 5)
+    save_data.b_unknown02 = b'\x00' * 17
+    save_data.characters = []
+    for i in range(count):
+        png = make_png(png_size[0], png_size[1], seed=i)
+        save_data.characters.append(make_character(i, png, outfits, kkex_size, i == 0))
+    save_data.save(filename)
+    return save_data
+
+
+def measure(func, repeat):
+    u"""best wall time of repeat runs and peak traced memory of one more run"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def bench_file(filename, repeat=3, workers=None):
+    u"""yield (name, seconds, peak memory, bytes, characters) per benchmark"""
+    size = os.path.getsize(filename)
+    count = len(KoikatuSaveData(filename, lazy=True).characters)
+
+    loads = [
+        ('load', {}),
+        ('load lazy', {'lazy': True}),
+        ('load mmap lazy', {'use_mmap': True, 'lazy': True}),
+    ]
+    if workers:
+        loads.append((f'load workers={workers}', {'workers': workers}))
+    for name, kwargs in loads:
+        def load():
+            KoikatuSaveData(filename, **kwargs)
+        yield (name, *measure(load, repeat), size, count)
+
+    save_data = KoikatuSaveData(filename)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out = Path(tmpdir) / 'out.dat'
+        elapsed, peak = measure(lambda: save_data.save(out), repeat)
+        yield ('save unchanged', elapsed, peak, size, count)
+
+        def save_dirty():
+            for chara in save_data.characters:
+                chara.mark_dirty()
+            save_data.save(out)
+        elapsed, peak = measure(save_dirty, repeat)
+        yield ('save re-encoded', elapsed, peak, size, count)
+
+    # decode each info block of every character on its own
+    blocks = {}
+    for chara in save_data.characters:
+        for info in chara.list_info['lstInfo']:
+            part = chara.chara_data[info['pos']:info['pos'] + info['size']]
+            blocks.setdefault(info['name'], []).append((chara, part))
+    for name, parts in blocks.items():
+        def decode():
+            for chara, part in parts:
+                chara._read_info(name, part)
+        elapsed, peak = measure(decode, repeat)
+        yield (f'decode {name}', elapsed, peak, sum(len(p) for _, p in parts), len(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_data', nargs='?',
+                        help='benchmark this save instead of a synthetic one')
+    parser.add_argument('-n', '--characters', type=int, default=60)
+    parser.add_argument('--png-size', default='252x352',
+                        help='size of the character portraits (WxH)')
+    parser.add_argument('--outfits', type=int, default=3)
+    parser.add_argument('--kkex', type=int, default=0,
+                        help='size of a KKEx block added to each character')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='also benchmark parallel loading')
+    parser.add_argument('--keep', help='keep the synthetic save under this name')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = args.save_data
+        if filename is None:
+            filename = args.keep or Path(tmpdir) / 'bench.dat'
+            width, height = (int(v) for v in args.png_size.split('x'))
+            make_save(filename, args.characters, (width, height),
+                      args.outfits, args.kkex)
+
+        size = os.path.getsize(filename)
+        print(f'{filename}: {size / 2**20:.2f} MB')
+        print(f'{"":24} {"time":>10} {"MB/s":>9} {"chara/s":>10} {"peak MB":>9}')
+        for name, elapsed, peak, nbytes, count in bench_file(filename, args.repeat, args.workers):
+            elapsed = max(elapsed, 1e-9)
+            print(f'{name:24} {elapsed * 1000:8.1f}ms {nbytes / 2**20 / elapsed:9.1f}'
+                  f' {count / elapsed:10.0f} {peak / 2**20:9.2f}')
+
+
+if __name__ == '__main__':
+    main()
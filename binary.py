@@ -0,0 +1,166 @@
+import contextlib
+import os
+import shutil
+import struct
+import tempfile
+
+# precompiled codecs of the primitive values in cards and save data
+BYTE = struct.Struct('b')
+SHORT = struct.Struct('H')
+INT = struct.Struct('<i')
+INT_BE = struct.Struct('!i')
+LONG = struct.Struct('<q')
+
+# status of a character in save data: feeling, m_love, h_count, koikatu,
+# lover, anger, unknown byte, intelligence, strength (male) or date and
+# 3 unused bytes (female), ero
+STATUS_MALE = struct.Struct('<iiibbbciii')
+STATUS_FEMALE = struct.Struct('<iiibbbcib3xi')
+
+
+class BufferReader:
+    u"""file-like reader over a bytes-like buffer (bytes, bytearray, mmap)
+
+    read() returns bytes like a file does, view() returns a zero-copy
+    memoryview slice of the underlying buffer. offset is the position of
+    the buffer in its file, offset + tell() is the current file position.
+    """
+    def __init__(self, buffer, offset=0):
+        self.buffer = memoryview(buffer)
+        self.pos = 0
+        self.offset = offset
+
+
+    def read(self, size=-1):
+        return self.view(size).tobytes()
+
+
+    def view(self, size=-1):
+        start = self.pos
+        if size is None or size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(start + size, len(self.buffer))
+        self.pos = end
+        return self.buffer[start:end]
+
+
+    def unpack(self, codec):
+        values = codec.unpack_from(self.buffer, self.pos)
+        self.pos += codec.size
+        return values
+
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.buffer)
+        self.pos = max(0, pos)
+        return self.pos
+
+
+    def tell(self):
+        return self.pos
+
+
+class BufferWriter:
+    u"""writer into a single growing bytearray
+
+    pack() encodes values in place with Struct.pack_into, write() copies
+    bytes-like objects. getvalue() returns the bytearray trimmed to size.
+    """
+    def __init__(self, size=0):
+        self.buffer = bytearray(size)
+        self.pos = 0
+
+
+    def _reserve(self, size):
+        end = self.pos + size
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end - len(self.buffer), len(self.buffer))))
+        return end
+
+
+    def write(self, data):
+        end = self._reserve(len(data))
+        self.buffer[self.pos:end] = data
+        self.pos = end
+
+
+    def pack(self, codec, *values):
+        end = self._reserve(codec.size)
+        codec.pack_into(self.buffer, self.pos, *values)
+        self.pos = end
+
+
+    def tell(self):
+        return self.pos
+
+
+    def getvalue(self):
+        del self.buffer[self.pos:]
+        return self.buffer
+
+
+@contextlib.contextmanager
+def atomic_write(path, fsync=False):
+    u"""binary file to write path through a temporary file next to it
+
+    The temporary file replaces path when the block ends, so a crash while
+    writing leaves the old file intact, and is removed if the block raises.
+    With fsync, the data is on disk before the file is replaced.
+    """
+    fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            yield out
+            if fsync:
+                out.flush()
+                os.fsync(out.fileno())
+        _copy_mode(path, tmpname)
+        os.replace(tmpname, path)
+    except BaseException:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        raise
+
+
+def _copy_mode(path, tmpname):
+    # mkstemp creates the file readable by the owner only
+    if os.path.exists(path):
+        shutil.copymode(path, tmpname)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+
+
+def write_buffers(file, buffers):
+    u"""write all buffers to a file, with one os.writev call per batch
+    where available (not on Windows) instead of one write per buffer"""
+    if not hasattr(os, 'writev'):
+        for buffer in buffers:
+            file.write(buffer)
+        return
+
+    file.flush()
+    fd = file.fileno()
+    try:
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        iov_max = 1024
+    views = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+    i = 0
+    while i < len(views):
+        written = os.writev(fd, views[i:i + iov_max])
+        # skip what is written, writev may stop within a buffer
+        while written > 0:
+            if written >= len(views[i]):
+                written -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][written:]
+                written = 0
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+from pathlib import Path
+
+from binary import atomic_write
+
+MANIFEST_VERSION = 1
+
+# blobs of a character in a manifest, and the file names of dump_characters()
+BLOB_FILES = (
+    ('png', '.png'),
+    ('chara_data', '.char.dat'),
+    ('before_additional', '.additional0.dat'),
+    ('after_additional', '.additional2.dat'),
+)
+
+
+class BlobStore:
+    u"""content-addressed store, each distinct blob is written once
+
+    Blobs are files named by their hash under root/ab/cdef..., so any
+    number of processes can add to the same store.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # keys known to be stored, saves the stat of repeated blobs
+        self._known = set()
+
+
+    def key(self, data):
+        return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+    def path(self, key):
+        return self.root / key[:2] / key[2:]
+
+
+    def put(self, data):
+        u"""store data unless it is stored already, returns its key"""
+        key = self.key(data)
+        if key in self._known:
+            return key
+        path = self.path(key)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # another process may write the same blob meanwhile
+            with atomic_write(path) as out:
+                out.write(data)
+        self._known.add(key)
+        return key
+
+
+    def get(self, key):
+        with open(self.path(key), 'rb') as file:
+            return file.read()
+
+
+def dump_to_store(characters, store, manifest, source=None):
+    u"""store the blobs of each character and write a manifest of their keys
+
+    The manifest is the JSON counterpart of the files of dump_characters(),
+    with the additional counters inline. Returns the number of characters.
+    """
+    entries = []
+    for chara in characters:
+        entry = {name: store.put(getattr(chara, name)) for name, _ in BLOB_FILES}
+        entry['additional'] = {key: chara.additional[key] for key in chara.additional_keys}
+        entries.append(entry)
+
+    manifest = Path(manifest)
+    manifest.parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest, 'w', encoding='utf-8') as out:
+        json.dump({'version': MANIFEST_VERSION,
+                   'source': str(source) if source is not None else None,
+                   'characters': entries}, out, ensure_ascii=False, indent=1)
+    return len(entries)
+
+
+def unpack_manifest(manifest, store, outdir):
+    u"""write the files of dump_characters() from a manifest"""
+    with open(manifest, encoding='utf-8') as file:
+        entries = json.load(file)['characters']
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    for i, entry in enumerate(entries):
+        for name, suffix in BLOB_FILES:
+            with open(outdir / f'char_{i:03}{suffix}', 'wb') as out:
+                out.write(store.get(entry[name]))
+        with open(outdir / f'char_{i:03}.additional1.txt', 'w') as out:
+            for key, value in entry['additional'].items():
+                print(f'{key:16} : {value:04x}', file=out)
+    return len(entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='write the files of a manifest of a store')
+    parser.add_argument('manifest')
+    parser.add_argument('-s', dest='store', help='store directory (default: objects next to the manifest)')
+    parser.add_argument('-o', dest='outdir', default='cards', help='output directory')
+
+    args = parser.parse_args()
+
+    store = BlobStore(args.store or Path(args.manifest).parent / 'objects')
+    count = unpack_manifest(args.manifest, store, args.outdir)
+    print(f'{count} characters')
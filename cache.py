@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from save_data import KoikatuSaveData
+
+DEFAULT_PATH = Path.home() / '.cache' / 'KoikatuSaveDataEdit' / 'saves.sqlite'
+
+# bytes hashed at the start, at the end and at each sample in between
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 16
+
+SUMMARY_FIELDS = (
+    'number', 'offset', 'size', 'png_offset', 'png_length',
+    'lastname', 'firstname', 'nickname', 'sex', 'personality',
+    'feeling', 'm_love', 'h_count', 'koikatu', 'lover', 'anger',
+    'strength', 'date', 'ero', 'intimacy',
+)
+
+CharacterSummary = namedtuple('CharacterSummary', SUMMARY_FIELDS)
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS saves (
+    id INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash BLOB NOT NULL,
+    version TEXT NOT NULL,
+    school TEXT NOT NULL,
+    nbytes INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    UNIQUE (size, mtime_ns, hash)
+);
+CREATE TABLE IF NOT EXISTS characters (
+    save_id INTEGER NOT NULL REFERENCES saves (id) ON DELETE CASCADE,
+    {", ".join(SUMMARY_FIELDS)},
+    PRIMARY KEY (save_id, number)
+);
+CREATE INDEX IF NOT EXISTS saves_last_used ON saves (last_used);
+'''
+
+
+def file_key(filename):
+    u"""(size, mtime, hash) of a file, the hash is of samples of the content
+
+    Only the start, the end and SAMPLE_COUNT blocks in between are hashed,
+    the mtime catches changes elsewhere (e.g. patched status values).
+    """
+    with open(filename, 'rb') as file:
+        stat = os.fstat(file.fileno())
+        h = hashlib.blake2b(digest_size=16)
+        h.update(stat.st_size.to_bytes(8, 'little'))
+        if stat.st_size <= SAMPLE_SIZE * (SAMPLE_COUNT + 2):
+            h.update(file.read())
+        else:
+            step = (stat.st_size - SAMPLE_SIZE) // (SAMPLE_COUNT + 1)
+            for i in range(SAMPLE_COUNT + 2):
+                file.seek(i * step)
+                h.update(file.read(SAMPLE_SIZE))
+    return stat.st_size, stat.st_mtime_ns, h.digest()
+
+
+def summarize(index, chara):
+    u"""CharacterSummary of a loaded character, only Parameter is decoded"""
+    # product_no, marker, version, png length
+    png_offset = chara.offset + 4 + 1 + chara.marker[1] + 1 + chara.unknown01[1] + 4
+    return CharacterSummary(
+        index, chara.offset, len(chara._dump()), png_offset, chara.png_length,
+        chara.lastname, chara.firstname, chara.nickname, chara.sex, chara.personality,
+        chara.feeling, chara.m_love, chara.h_count, chara.koikatu, chara.lover,
+        chara.anger, int(chara.strength), chara.date, int(chara.ero), int(chara.intimacy),
+    )
+
+
+class SaveCache:
+    u"""SQLite cache of character summaries of save files
+
+    Entries are keyed by file_key(), so a renamed copy of a save is found
+    too. The least recently used entries are dropped when there are more
+    than max_entries or they take more than max_bytes.
+    """
+    def __init__(self, path=DEFAULT_PATH, max_entries=256, max_bytes=16 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if path != ':memory:':
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path))
+        self._db.execute('PRAGMA foreign_keys = ON')
+        self._db.executescript(SCHEMA)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self._db.close()
+
+
+    def characters(self, filename):
+        u"""summaries of the characters of a save, loaded on a cache miss"""
+        key = file_key(filename)
+        summaries = self._lookup(key)
+        if summaries is not None:
+            return summaries
+
+        save_data = KoikatuSaveData(filename, lazy=True)
+        summaries = [summarize(i, chara) for i, chara in enumerate(save_data.characters)]
+        # not cached if the file changed while it was read
+        if file_key(filename) == key:
+            self._store(key, save_data.version_num, save_data.school[0], summaries)
+        return summaries
+
+
+    def lookup(self, filename):
+        u"""cached summaries of a save, or None"""
+        return self._lookup(file_key(filename))
+
+
+    def clear(self):
+        with self._db:
+            self._db.execute('DELETE FROM saves')
+
+
+    def _lookup(self, key):
+        row = self._db.execute('SELECT id FROM saves WHERE size = ? AND mtime_ns = ? AND hash = ?',
+                               key).fetchone()
+        if row is None:
+            return None
+        with self._db:
+            self._db.execute('UPDATE saves SET last_used = ? WHERE id = ?', (time.time(), row[0]))
+        rows = self._db.execute(f'SELECT {", ".join(SUMMARY_FIELDS)} FROM characters'
+                                ' WHERE save_id = ? ORDER BY number', row).fetchall()
+        return [CharacterSummary(*row) for row in rows]
+
+
+    def _store(self, key, version, school, summaries):
+        # rough size of the rows, for the max_bytes limit
+        nbytes = sum(8 * len(SUMMARY_FIELDS)
+                     + len(f'{s.lastname}{s.firstname}{s.nickname}'.encode())
+                     for s in summaries)
+        placeholders = ', '.join('?' * len(SUMMARY_FIELDS))
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT OR REPLACE INTO saves (size, mtime_ns, hash, version, school, nbytes, last_used)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)', (*key, version, school, nbytes, time.time()))
+            save_id = cursor.lastrowid
+            self._db.executemany(f'INSERT INTO characters VALUES (?, {placeholders})',
+                                 [(save_id, *s) for s in summaries])
+            self._evict()
+
+
+    def _evict(self):
+        rows = self._db.execute('SELECT id, nbytes FROM saves ORDER BY last_used DESC').fetchall()
+        total = 0
+        for i, (save_id, nbytes) in enumerate(rows):
+            total += nbytes
+            if i >= self.max_entries or total > self.max_bytes:
+                self._db.execute('DELETE FROM saves WHERE id = ?', (save_id,))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_data', nargs='*')
+    parser.add_argument('--cache', default=DEFAULT_PATH, help='cache file')
+    parser.add_argument('--clear', action='store_true', help='empty the cache first')
+
+    args = parser.parse_args()
+
+    with SaveCache(args.cache) as cache:
+        if args.clear:
+            cache.clear()
+        for filename in args.save_data:
+            print(f'{filename}:')
+            for s in cache.characters(filename):
+                print(f'{s.number:4} {s.lastname} {s.firstname} ({s.nickname})'
+                      f' sex={s.sex} personality={s.personality} feeling={s.feeling}')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+import argparse
+import io
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+from character import KoikatuCharacter
+
+DEFAULT_PATH = Path.home() / '.cache' / 'KoikatuSaveDataEdit' / 'cards.sqlite'
+
+# size of the previews of the card picker
+PREVIEW_SIZE = (126, 176)
+
+# cards parsed per batch, each batch is committed so that readers see it
+BATCH_SIZE = 256
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cards (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    valid INTEGER NOT NULL,
+    lastname TEXT,
+    firstname TEXT,
+    nickname TEXT,
+    sex INTEGER,
+    personality INTEGER,
+    preview BLOB
+);
+CREATE INDEX IF NOT EXISTS cards_sex ON cards (sex);
+'''
+
+CARD_FIELDS = ('path', 'lastname', 'firstname', 'nickname', 'sex', 'personality')
+
+
+def read_card(path):
+    u"""(valid, lastname, firstname, nickname, sex, personality, preview)
+
+    Only list_info and Parameter of the card are decoded. Other PNG files
+    in the folder give a row with valid 0, so they are not read again.
+    """
+    try:
+        with open(path, 'rb') as infile:
+            chara = KoikatuCharacter(infile, True, lazy=True)
+        image = Image.open(io.BytesIO(chara.card_png))
+        image.thumbnail(PREVIEW_SIZE)
+        preview = io.BytesIO()
+        image.save(preview, 'PNG')
+        return (1, chara.lastname, chara.firstname, chara.nickname,
+                chara.sex, chara.personality, preview.getvalue())
+    except Exception:
+        return (0, None, None, None, None, None, None)
+
+
+def _read_cards(paths):
+    return [read_card(path) for path in paths]
+
+
+def find_cards(folder):
+    u"""{path: (size, mtime_ns)} of the PNG files under folder"""
+    found = {}
+    stack = [str(folder)]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith('.png'):
+                stat = entry.stat()
+                found[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return found
+
+
+class CardIndex:
+    u"""SQLite index of the character cards of a folder
+
+    scan() parses only new and changed cards (by size and mtime), in
+    processes, and drops cards which are gone. A connection belongs to the
+    thread that opened it, so the scan of the GUI has its own CardIndex.
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        if path != ':memory:':
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), timeout=30)
+        if path != ':memory:':
+            # readers are not blocked by a running scan
+            self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.executescript(SCHEMA)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self._db.close()
+
+
+    def scan(self, folder, workers=None, progress=None):
+        u"""index the cards under folder, returns the number of cards parsed
+
+        progress(done, total) is called after each batch.
+        """
+        prefix = os.path.join(str(folder), '')
+        found = find_cards(folder)
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self._db.execute(
+            'SELECT path, size, mtime_ns FROM cards WHERE substr(path, 1, ?) = ?',
+            (len(prefix), prefix))}
+
+        with self._db:
+            self._db.executemany('DELETE FROM cards WHERE path = ?',
+                                 [(path,) for path in known if path not in found])
+        paths = [path for path, key in found.items() if known.get(path) != key]
+        total = len(paths)
+        if total == 0:
+            return 0
+
+        batches = [paths[i:i + BATCH_SIZE] for i in range(0, total, BATCH_SIZE)]
+        done = 0
+        if workers == 1 or len(batches) < 2:
+            results = map(_read_cards, batches)
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            futures = [executor.submit(_read_cards, batch) for batch in batches]
+            results = (future.result() for future in futures)
+        try:
+            for batch, rows in zip(batches, results):
+                with self._db:
+                    self._db.executemany(
+                        'INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(path, *found[path], *row) for path, row in zip(batch, rows)])
+                done += len(batch)
+                if progress is not None:
+                    progress(done, total)
+        finally:
+            if executor is not None:
+                # the batches not started yet, if the scan failed
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+        return total
+
+
+    def find(self, text='', sex=None, folder=None, limit=1000):
+        u"""cards whose names or file name contain text, as
+        (path, lastname, firstname, nickname, sex, personality) tuples
+        """
+        where = ['valid = 1']
+        args = []
+        for word in text.split():
+            where.append("(lastname || ' ' || firstname || ' ' || nickname || ' ' || path)"
+                         " LIKE ? ESCAPE '\\'")
+            word = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            args.append(f'%{word}%')
+        if sex is not None:
+            where.append('sex = ?')
+            args.append(sex)
+        if folder is not None:
+            prefix = os.path.join(str(folder), '')
+            where.append('substr(path, 1, ?) = ?')
+            args += [len(prefix), prefix]
+        return self._db.execute(
+            f'SELECT {", ".join(CARD_FIELDS)} FROM cards WHERE {" AND ".join(where)}'
+            ' ORDER BY lastname, firstname, path LIMIT ?', (*args, limit)).fetchall()
+
+
+    def preview(self, path):
+        u"""PNG bytes of the preview of a card, or None"""
+        row = self._db.execute('SELECT preview FROM cards WHERE path = ?', (path,)).fetchone()
+        return row[0] if row is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='index and search the character cards of a folder')
+    parser.add_argument('folder')
+    parser.add_argument('text', nargs='*', help='words in the names or file names')
+    parser.add_argument('--index', default=DEFAULT_PATH, help='index file')
+    parser.add_argument('--sex', type=int, choices=(0, 1), default=None)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='parse the cards in this many processes')
+
+    # the options may come after the words
+    args = parser.parse_intermixed_args()
+
+    folder = os.path.abspath(args.folder)
+    with CardIndex(args.index) as index:
+        count = index.scan(folder, args.workers)
+        print(f'{count} cards parsed')
+        for path, lastname, firstname, nickname, sex, personality in index.find(
+                ' '.join(args.text), args.sex, folder):
+            print(f'{lastname} {firstname} ({nickname}) sex={sex} {path}')
+    return 0
+
+
+if __name__ == '__main__':
+    main()
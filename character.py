@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 import argparse
-import struct
-import io
+import copy
 import pprint
+import threading
 import msgpack
 
+from binary import (BYTE, INT, INT_BE, LONG, SHORT, STATUS_FEMALE, STATUS_MALE,
+                    BufferReader, BufferWriter)
+
 AC_MAP = [
     b'\x00\x30',
     b'\x20\x41',
@@ -19,11 +22,216 @@ AC_MAP = [
     b'\xC8\x42',
 ]
 
+INFO_NAMES = ('Custom', 'Coordinate', 'Parameter', 'Status', 'KKEx')
+
+# fixed-width fields which can be overwritten in place, besides the
+# 4 byte ac values and the additional counters (INT)
+FIELD_CODECS = {
+    'feeling': INT,
+    'm_love': INT,
+    'h_count': INT,
+    'koikatu': BYTE,
+    'lover': BYTE,
+    'anger': BYTE,
+    'strength': INT,
+    'date': BYTE,
+    'ero': INT,
+    'eventAfterDay': INT,
+    'isFirstGirlfriend': BYTE,
+    'intimacy': INT,
+}
+
+# offsets of these fields in the status record
+STATUS_FIELDS = (('feeling', 0), ('m_love', 4), ('h_count', 8),
+                 ('koikatu', 12), ('lover', 13), ('anger', 14), ('ero', 24))
+STATUS_FIELDS_MALE = STATUS_FIELDS + (('strength', 20),)
+STATUS_FIELDS_FEMALE = STATUS_FIELDS + (('date', 20),)
+
+
+# str as str (the 'encoding' option is gone in msgpack 1.0), and the int map
+# keys of the appearance data, which msgpack 1.0 rejects by default
+UNPACK_OPTIONS = {'raw': False}
+if msgpack.version >= (0, 6, 1):
+    UNPACK_OPTIONS['strict_map_key'] = False
+
+
+class MsgpackCodec(threading.local):
+    u"""msgpack options and reused Packers, a set per thread
+
+    ext_hook and object_pairs_hook are used to unpack the
+    appearance blocks (Custom and Coordinate), which are only packed back
+    here, so they may build more compact objects which pack to the same
+    bytes.
+    """
+    def __init__(self, ext_hook=None, object_pairs_hook=None):
+        self.hooks = {}
+        if ext_hook is not None:
+            self.hooks['ext_hook'] = ext_hook
+        if object_pairs_hook is not None:
+            self.hooks['object_pairs_hook'] = object_pairs_hook
+        self._unpack_options = {}
+        self._packers = {}
+
+
+    def unpack(self, data, use_list=True, raw=False, hooks=False):
+        key = (use_list, raw, hooks)
+        options = self._unpack_options.get(key)
+        if options is None:
+            options = dict(UNPACK_OPTIONS, use_list=use_list, raw=raw)
+            if hooks:
+                options.update(self.hooks)
+            self._unpack_options[key] = options
+        # as fast as a reused Unpacker, which has to copy the data in
+        return msgpack.unpackb(data, **options)
+
+
+    def pack(self, value, single_float=True, strict_types=False):
+        key = (single_float, strict_types)
+        packer = self._packers.get(key)
+        if packer is None:
+            packer = self._packers[key] = msgpack.Packer(
+                use_single_float=single_float, use_bin_type=True, strict_types=strict_types)
+        return packer.pack(value)
+
+
+def _tracked(name, changed=None):
+    u"""property stored in '_' + name which records changed values"""
+    attr = '_' + name
+    key = changed or name
+
+    def fget(self):
+        return getattr(self, attr)
+
+    def fset(self, value):
+        if not hasattr(self, attr) or getattr(self, attr) != value:
+            self._changed.add(key)
+        setattr(self, attr, value)
+
+    return property(fget, fset)
+
+
+class _TrackedDict(dict):
+    u"""dict which records the keys set or removed in it in .changed"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changed = set()
+
+    def __reduce__(self):
+        return (_restore_tracked_dict, (dict(self), self.changed))
+
+    def __setitem__(self, key, value):
+        if key not in self or dict.__getitem__(self, key) != value:
+            self.changed.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed.add(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *default):
+        if key in self:
+            self.changed.add(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.changed.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.changed.update(self)
+        super().clear()
+
+
+def _restore_tracked_dict(items, changed):
+    value = _TrackedDict(items)
+    value.changed = changed
+    return value
+
+
+def _tracked_dict(name, changed):
+    u"""property of a _TrackedDict stored in '_' + name, assigning another
+    dict records changed"""
+    attr = '_' + name
+
+    def fget(self):
+        return getattr(self, attr)
+
+    def fset(self, value):
+        if not hasattr(self, attr) or getattr(self, attr) != value:
+            self._changed.add(changed)
+        if not isinstance(value, _TrackedDict):
+            value = _TrackedDict(value)
+        setattr(self, attr, value)
+
+    return property(fget, fset)
+
 
 class KoikatuCharacter:
-    def __init__(self, data, with_card=True, skip_additional=False,master_version="0.0.0"):
+    # msgpack of all characters, replace it to set hooks
+    codec = MsgpackCodec()
+
+    parameter = _tracked_dict('parameter', 'Parameter')
+    # changes of single keys are recorded as 'ac.mune', 'additional.Idle'
+    ac = _tracked_dict('ac', 'ac')
+    additional = _tracked_dict('additional', 'additional')
+    additional_keys = _tracked('additional_keys')
+    list_info = _tracked('list_info')
+    product_no = _tracked('product_no')
+    marker = _tracked('marker')
+    unknown01 = _tracked('unknown01')
+    unknown02 = _tracked('unknown02')
+    unknown_mark = _tracked('unknown_mark')
+    unknown03 = _tracked('unknown03')
+    unknown06 = _tracked('unknown06')
+    unknown07 = _tracked('unknown07')
+    card_png = _tracked('card_png')
+    png_length = _tracked('png_length')
+    png = _tracked('png')
+    ex_data = _tracked('ex_data')
+    dearname = _tracked('dearname')
+    feeling = _tracked('feeling')
+    m_love = _tracked('m_love')
+    h_count = _tracked('h_count')
+    koikatu = _tracked('koikatu')
+    lover = _tracked('lover')
+    anger = _tracked('anger')
+    strength = _tracked('strength')
+    ero = _tracked('ero')
+    date = _tracked('date')
+    before_additional = _tracked('before_additional')
+    intimacy = _tracked('intimacy')
+    eventAfterDay = _tracked('eventAfterDay')
+    isFirstGirlfriend = _tracked('isFirstGirlfriend')
+    after_additional = _tracked('after_additional')
+
+    def __init__(self, data, with_card=True, skip_additional=False,master_version="0.0.0", lazy=False):
+        # names of the fields changed since loading, see save()
+        self._changed = set()
+        # file offsets of the fixed-width fields, see _patches()
+        self._offsets = {}
+        if not isinstance(data, BufferReader):
+            data = BufferReader(data.read())
+        raw_start = data.tell()
+        # position of the character in the file it is read from
+        self.offset = data.offset + raw_start
         self.master_version = master_version
         self.with_card = with_card
+        # (file offset, length) of the views kept of data, see _strip_views()
+        self._views = {}
         if with_card:
             # read first PNG
             self.card_png = self._read_png(data)
@@ -37,37 +245,40 @@ class KoikatuCharacter:
 
         # second PNG
         self.png_length = self._read_int(data)
+        self._views['_png'] = (data.offset + data.tell(), 0)
         self.png = self._read_png(data)
 
         # list info
         self.list_info_size = self._read_int(data)
         self.list_info_data = data.read(self.list_info_size)
-        self.list_info = msgpack.unpackb(self.list_info_data,
-                                         encoding='utf8')
+        self.list_info = self._read_list_info(self.list_info_data)
         #print('listinfo:', self.list_info)
 
         # character info
-        self.chara_datasize = struct.unpack("q", data.read(8))[0]
-        self.chara_data = data.read(self.chara_datasize)
+        self.chara_datasize = data.unpack(LONG)[0]
+        self._views['chara_data'] = (data.offset + data.tell(), 0)
+        self.chara_data = data.view(self.chara_datasize)
         self.info_order = []
-        self.kkex = None
+        self._kkex = None
+        # raw bytes of the blocks which are not decoded yet (lazy mode)
+        self._pending = {}
+        # (pos, size) in chara_data of each block as loaded, and the blocks
+        # handed out by a getter, which may have been edited in place
+        self._blocks = {}
+        self._handed_out = set()
         for info in self.list_info['lstInfo']:
             self.info_order.append(info['name'])
             start = info['pos']
             end = info['pos'] + info['size']
+            self._blocks[info['name']] = (start, info['size'])
             part = self.chara_data[start:end]
-            if info['name'] == 'Custom':
-                self._read_custom(part)
-            elif info['name'] == 'Coordinate':
-                self._read_coordinate(part)
-            elif info['name'] == 'Parameter':
-                self._read_parameter(part)
-            elif info['name'] == 'Status':
-                self._read_status(part)
-            elif info['name'] == 'KKEx':
-                self._read_kkex(part)
-            else:
+            if info['name'] not in INFO_NAMES:
                 raise ValueError(f'Unsupported info {info["name"]}')
+            # Parameter is always decoded, the sex is needed below
+            if lazy and info['name'] != 'Parameter':
+                self._pending[info['name']] = part
+            else:
+                self._read_info(info['name'], part)
 
         #print('name:', self.firstname, self.lastname)
 
@@ -80,21 +291,17 @@ class KoikatuCharacter:
         self.isFirstGirlfriend = False
         if not with_card:
             # additional info
+            ex_start = data.tell()
             len1 = self._read_byte(data)
             if len1 == 4:
                 marker = data.read(len1)
                 if marker == b'KKEx':
-                    # bepinex extensible format
-                    version = self._read_int(data)
+                    # bepinex extensible format: length, marker, version, size, data
+                    data.seek(4, 1)
                     len2 = self._read_int(data)
-                    ex_data = data.read(len2)
-                    self.ex_data = b''.join([
-                        self._pack_byte(len1),
-                        marker,
-                        self._pack_int(version),
-                        self._pack_int(len2),
-                        ex_data
-                    ])
+                    data.seek(ex_start)
+                    self._views['_ex_data'] = (data.offset + ex_start, 0)
+                    self.ex_data = data.view(13 + len2)
             else:
                 data.seek(-1, 1)
 
@@ -104,39 +311,32 @@ class KoikatuCharacter:
             self.dearname = self._read_utf8_string(data)
             #print('dear:', self.dearname)
 
-            self.feeling = self._read_int(data)
-            self.m_love = self._read_int(data)
-            self.h_count = self._read_int(data)
-            self.koikatu = self._read_byte(data)
-            self.lover = self._read_byte(data)
-            self.anger = self._read_byte(data)
-
-            self.unknown03 = data.read(1)
-
-            self.intelligence = self._read_int(data)
+            # status, strength for male or date (and 3 unused bytes) for female
+            status_start = data.offset + data.tell()
+            for name, offset in (STATUS_FIELDS_MALE if self.sex == 0
+                                 else STATUS_FIELDS_FEMALE):
+                self._offsets[name] = status_start + offset
             if self.sex == 0:
-                self.strength = self._read_int(data)
+                (self.feeling, self.m_love, self.h_count,
+                 self.koikatu, self.lover, self.anger, self.unknown03,
+                 self.intelligence, self.strength, self.ero) = data.unpack(STATUS_MALE)
                 self._date = 0
             else:
-                self._date = self._read_byte(data)
-                data.read(3) # not use
+                (self.feeling, self.m_love, self.h_count,
+                 self.koikatu, self.lover, self.anger, self.unknown03,
+                 self.intelligence, self._date, self.ero) = data.unpack(STATUS_FEMALE)
                 self.strength = 0
 
-            self.ero = self._read_int(data)
-
             if not skip_additional:
                 self.unknown06 = data.read(14)
 
-                self.ac['mune'] = data.read(4)
-                self.ac['kokan'] = data.read(4)
-                self.ac['anal'] = data.read(4)
-                self.ac['siri'] = data.read(4)
-                self.ac['tikubi'] = data.read(4)
+                for key in ('mune', 'kokan', 'anal', 'siri', 'tikubi'):
+                    self._read_ac(data, key)
 
                 self.unknown07 = data.read(14)
 
-                self.ac['kokan_piston'] = data.read(4)
-                self.ac['anal_piston'] = data.read(4)
+                self._read_ac(data, 'kokan_piston')
+                self._read_ac(data, 'anal_piston')
             else:
                 self.unknown06 = b''
                 self.ac['mune'] = b''
@@ -149,7 +349,13 @@ class KoikatuCharacter:
                 self.ac['anal_piston'] = b''
 
             self._read_additional(data)
-  
+
+        for key, (offset, _) in self._views.items():
+            self._views[key] = (offset, len(getattr(self, key)))
+        # original bytes, written back as long as nothing is changed
+        self._raw = data.buffer[raw_start:data.tell()]
+        self._clear_changes()
+
 
     @property
     def firstname(self):
@@ -157,7 +363,7 @@ class KoikatuCharacter:
 
     @firstname.setter
     def firstname(self, value):
-        self.parameter['firstname'] = value
+        self._set_parameter('firstname', value)
 
     @property
     def lastname(self):
@@ -165,7 +371,7 @@ class KoikatuCharacter:
 
     @lastname.setter
     def lastname(self, value):
-        self.parameter['lastname'] = value
+        self._set_parameter('lastname', value)
 
     @property
     def nickname(self):
@@ -173,7 +379,7 @@ class KoikatuCharacter:
 
     @nickname.setter
     def nickname(self, value):
-        self.parameter['nickname'] = value
+        self._set_parameter('nickname', value)
 
     @property
     def intelligence(self):
@@ -181,7 +387,7 @@ class KoikatuCharacter:
 
     @intelligence.setter
     def intelligence(self, value):
-        self.parameter['intelligence'] = value     
+        self._set_parameter('intelligence', value)
 
     @property
     def physical(self):
@@ -189,7 +395,7 @@ class KoikatuCharacter:
 
     @physical.setter
     def physical(self, value):
-        self.parameter['physical'] = value 
+        self._set_parameter('physical', value)
 
     @property
     def hentai(self):
@@ -197,7 +403,7 @@ class KoikatuCharacter:
 
     @hentai.setter
     def hentai(self, value):
-        self.parameter['hentai'] = value          
+        self._set_parameter('hentai', value)
 
     @property
     def sex(self):
@@ -205,7 +411,7 @@ class KoikatuCharacter:
 
     @sex.setter
     def sex(self, value):
-        self.parameter['sex'] = value
+        self._set_parameter('sex', value)
 
     @property
     def answers(self):
@@ -213,7 +419,7 @@ class KoikatuCharacter:
 
     @answers.setter
     def answers(self, value):
-        self.parameter['awnser'] = value
+        self._set_parameter('awnser', value)
 
     @property
     def denials(self):
@@ -221,7 +427,7 @@ class KoikatuCharacter:
 
     @denials.setter
     def denials(self, value):
-        self.parameter['denial'] = value
+        self._set_parameter('denial', value)
 
     @property
     def attributes(self):
@@ -229,7 +435,7 @@ class KoikatuCharacter:
 
     @attributes.setter
     def attributes(self, value):
-        self.parameter['attribute'] = value
+        self._set_parameter('attribute', value)
 
     @property
     def personality(self):
@@ -237,7 +443,7 @@ class KoikatuCharacter:
 
     @personality.setter
     def personality(self, value):
-        self.parameter['personality'] = value
+        self._set_parameter('personality', value)
 
     @property
     def weak_point(self):
@@ -245,26 +451,91 @@ class KoikatuCharacter:
 
     @weak_point.setter
     def weak_point(self, value):
-        self.parameter['weakPoint'] = value
+        self._set_parameter('weakPoint', value)
 
     @property
-    def custom(self):
-        return (self.face, self.body, self.hair)
+    def face(self):
+        self._decode('Custom')
+        self._handed_out.add('Custom')
+        return self._face
+
+    @face.setter
+    def face(self, value):
+        self._decode('Custom')
+        self._changed.add('Custom')
+        self._face = value
 
     @property
-    def date(self):
-        return self._date
+    def body(self):
+        self._decode('Custom')
+        self._handed_out.add('Custom')
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._decode('Custom')
+        self._changed.add('Custom')
+        self._body = value
 
-    @date.setter
-    def date(self, value):
-        self._date = value
+    @property
+    def hair(self):
+        self._decode('Custom')
+        self._handed_out.add('Custom')
+        return self._hair
 
+    @hair.setter
+    def hair(self, value):
+        self._decode('Custom')
+        self._changed.add('Custom')
+        self._hair = value
+
+    @property
+    def custom(self):
+        return (self.face, self.body, self.hair)
 
     @custom.setter
     def custom(self, value):
-        self.face = value[0]
-        self.body = value[1]
-        self.hair = value[2]
+        self._pending.pop('Custom', None)
+        self._changed.add('Custom')
+        self._face = value[0]
+        self._body = value[1]
+        self._hair = value[2]
+
+    @property
+    def coordinates(self):
+        self._decode('Coordinate')
+        self._handed_out.add('Coordinate')
+        return self._coordinates
+
+    @coordinates.setter
+    def coordinates(self, value):
+        self._pending.pop('Coordinate', None)
+        self._changed.add('Coordinate')
+        self._coordinates = value
+
+    @property
+    def status(self):
+        self._decode('Status')
+        self._handed_out.add('Status')
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._pending.pop('Status', None)
+        self._changed.add('Status')
+        self._status = value
+
+    @property
+    def kkex(self):
+        self._decode('KKEx')
+        self._handed_out.add('KKEx')
+        return self._kkex
+
+    @kkex.setter
+    def kkex(self, value):
+        self._pending.pop('KKEx', None)
+        self._changed.add('KKEx')
+        self._kkex = value
 
     def get_ac(self, key):
         if len(self.ac[key]) > 0:
@@ -280,29 +551,116 @@ class KoikatuCharacter:
         if len(self.ac[key]) > 0:
             self.ac[key] = self.ac[key][0:2] + AC_MAP[value]
 
+    def set_additional(self, key, value):
+        if key not in self.additional:
+            self.additional_keys.append(key)
+        self.additional[key] = value
+
+    @property
+    def dirty(self):
+        return len(self._changes()) > 0
+
+    def mark_dirty(self, name='*'):
+        u"""record a change, so that the character is encoded again on save"""
+        self._changed.add(name)
+
+    def _changes(self):
+        u"""names of the changed fields, with the keys set in ac and additional"""
+        changes = set(self._changed)
+        changes.update(f'ac.{key}' for key in self.ac.changed)
+        changes.update(f'additional.{key}' for key in self.additional.changed)
+        if self.parameter.changed:
+            changes.add('Parameter')
+        changes.update(self._changed_blocks(changes))
+        return changes
+
+    def _changed_blocks(self, changes):
+        u"""blocks edited in place, e.g. c.status['mouthPtn'] = 5
+
+        Parameter and the blocks handed out by a getter are encoded again
+        and compared with the bytes they were loaded from.
+        """
+        packers = self._packers()
+        changed = set()
+        for name in self._handed_out | {'Parameter'}:
+            if name in changes or name in self._pending or name not in self.info_order:
+                continue
+            if name not in self._blocks:
+                changed.add(name)
+                continue
+            pos, size = self._blocks[name]
+            if packers[name]() != self.chara_data[pos:pos + size]:
+                changed.add(name)
+        return changed
+
+    def _clear_changes(self):
+        self._changed.clear()
+        for value in (self.ac, self.additional, self.parameter):
+            value.changed.clear()
+
+    def replace_card(self, card):
+        u"""take the appearance, outfits, parameter, status and portrait of a
+        card (a KoikatuCharacter read with_card). Blocks the card has not
+        decoded are copied as bytes, without decoding and encoding them."""
+        for name, attr in (('Custom', 'custom'), ('Coordinate', 'coordinates'),
+                           ('Status', 'status')):
+            if name in card._pending:
+                self._pending[name] = card._pending[name]
+                self._changed.add(name)
+            else:
+                setattr(self, attr, getattr(card, attr))
+        self.parameter = copy.deepcopy(card.parameter)
+
+        # the blocks are in the format of the card
+        versions = {info['name']: info['version'] for info in card.list_info['lstInfo']}
+        for info in self.list_info['lstInfo']:
+            if info['name'] != 'KKEx' and info['name'] in versions:
+                info['version'] = versions[info['name']]
+
+        self.png_length = card.png_length
+        self.png = card.png
+
+    def _set_parameter(self, key, value):
+        if key not in self.parameter or self.parameter[key] != value:
+            self._changed.add('Parameter')
+        self.parameter[key] = value
+
     def _unpack_short(self, bytes_):
-        return struct.unpack('H', bytes_)
+        return SHORT.unpack(bytes_)
+
+    def _read_ac(self, data, key):
+        self._offsets[f'ac.{key}'] = data.offset + data.tell()
+        self.ac[key] = data.read(4)
 
 
     def save(self, out):
-        out.write(self._serialize())
+        out.write(self._dump())
+
+    def _dump(self):
+        # the original bytes if nothing is changed, otherwise re-encoded
+        if self._raw is not None and not self.dirty:
+            return self._raw
+        return self._serialize()
+
+    def _packers(self):
+        return {
+            'Custom' : self._pack_custom,
+            'Coordinate' : self._pack_coordinate,
+            'Parameter' : self._pack_parameter,
+            'Status' : self._pack_status,
+            'KKEx' : self._pack_kkex,
+        }
 
     def _serialize(self):
-        custom_s = self._pack_custom()
-        coordinate_s = self._pack_coordinate()
-        parameter_s = self._pack_parameter()
-        status_s = self._pack_status()
-
-        info_data = {
-            'Custom' : custom_s,
-            'Coordinate' : coordinate_s,
-            'Parameter' : parameter_s,
-            'Status' : status_s,
-        }
+        packers = self._packers()
 
-        if self.kkex is not None:
-            info_data['KKEx'] = self._pack_kkex()
-        chara_values = b"".join([info_data[key] for key in self.info_order])
+        info_data = {}
+        for key in self.info_order:
+            if key in self._pending:
+                # never decoded, write back the original bytes
+                info_data[key] = self._pending[key]
+            else:
+                info_data[key] = packers[key]()
 
         pos = 0
         for i, key in enumerate(self.info_order):
@@ -310,146 +668,228 @@ class KoikatuCharacter:
             self.list_info["lstInfo"][i]["size"] = len(info_data[key])
             pos += len(info_data[key])
 
-        list_info_s = msgpack.packb(self.list_info, use_single_float=True, use_bin_type=True)
+        list_info_s = self.codec.pack(self.list_info)
 
-        data = []
+        # room for the large parts, the writer grows for the rest
+        out = BufferWriter(len(self.png) + len(list_info_s) + pos + len(self.ex_data)
+                           + len(self.before_additional) + len(self.after_additional) + 256)
         if self.with_card:
-            data = [self.card_png]
+            out.write(self.card_png)
+
+        out.pack(INT, self.product_no)
+        out.write(self._pack_utf8_string(self.marker))
+        out.write(self._pack_utf8_string(self.unknown01))
+        out.pack(INT, self.png_length)
+        out.write(self.png)
+        out.pack(INT, len(list_info_s))
+        out.write(list_info_s)
+        out.pack(LONG, pos)
+        for key in self.info_order:
+            out.write(info_data[key])
 
+        self.parameter.setdefault('intelligence',0)
+
+        out.write(self.ex_data)
+        out.write(self.unknown02)
+        out.write(self.unknown_mark)
+        out.write(self._pack_utf8_string(self.dearname))
         if self.sex == 0:
-            bstr = self._pack_int(int(self.strength))
+            out.pack(STATUS_MALE, self.feeling, self.m_love, self.h_count,
+                     self.koikatu, self.lover, self.anger, self.unknown03,
+                     int(self.intelligence), int(self.strength), int(self.ero))
         else:
-            bstr = self._pack_byte(self._date) + b'\x00\x00\x00'
+            out.pack(STATUS_FEMALE, self.feeling, self.m_love, self.h_count,
+                     self.koikatu, self.lover, self.anger, self.unknown03,
+                     int(self.intelligence), self._date, int(self.ero))
+        out.write(self.unknown06)
+        for key in ('mune', 'kokan', 'anal', 'siri', 'tikubi'):
+            out.write(self.ac[key])
+        out.write(self.unknown07)
+        out.write(self.ac['kokan_piston'])
+        out.write(self.ac['anal_piston'])
+        out.write(self._pack_additional())
+
+        return out.getvalue()
+
+
+    def _patches(self):
+        u"""(file offset, bytes) of each changed field, or None if a changed
+        field is not fixed-width and the character has to be re-encoded"""
+        patches = []
+        for name in self._changes():
+            if name not in self._offsets:
+                return None
+            if name.startswith('ac.'):
+                value = self.ac.get(name[len('ac.'):], b'')
+                if len(value) != 4:
+                    return None
+            elif name.startswith('additional.'):
+                key = name[len('additional.'):]
+                if key not in self.additional or key not in self.additional_keys:
+                    return None
+                value = INT.pack(int(self.additional[key]))
+            else:
+                value = FIELD_CODECS[name].pack(int(getattr(self, name)))
+            patches.append((self._offsets[name], value))
+        return patches
 
-        self.parameter.setdefault('intelligence',0)
 
+    def _pack_chardata(self):
+        return self.chara_data
 
-        data += [
-            self._pack_int(self.product_no),
-            self._pack_utf8_string(self.marker),
-            self._pack_utf8_string(self.unknown01),
-            self._pack_int(self.png_length),
-            self.png,
-            self._pack_int(len(list_info_s)),
-            list_info_s,
-            struct.pack('q', len(chara_values)),
-            chara_values,
-            self.ex_data,
-            self.unknown02,
-            self.unknown_mark,
-            self._pack_utf8_string(self.dearname),
-            self._pack_int(self.feeling),
-            self._pack_int(self.m_love),
-            self._pack_int(self.h_count),
-            self._pack_byte(self.koikatu),
-            self._pack_byte(self.lover),
-            self._pack_byte(self.anger),
-            self.unknown03,
-            self._pack_int(int(self.intelligence)),
-            bstr,
-            self._pack_int(int(self.ero)),
-            self.unknown06,
-            self.ac['mune'],
-            self.ac['kokan'],
-            self.ac['anal'],
-            self.ac['siri'],
-            self.ac['tikubi'],
-            self.unknown07,
-            self.ac['kokan_piston'],
-            self.ac['anal_piston'],
-            self._pack_additional()
-        ]
-
-        return b''.join(data)
 
+    def _detach(self):
+        # replace views into a shared buffer (e.g. a mmap) with own copies,
+        # returns the names of those attributes for _attach_views()
+        names = {key for key, value in vars(self).items() if isinstance(value, memoryview)}
+        for key in names:
+            setattr(self, key, getattr(self, key).tobytes())
+        for key, value in self._pending.items():
+            if isinstance(value, memoryview):
+                self._pending[key] = value.tobytes()
+        return names
+
+
+    def _strip_views(self):
+        u"""drop the portrait, chara_data and the blocks not decoded, before
+        the character is sent to a process which has the same bytes"""
+        for key in self._views:
+            setattr(self, key, None)
+        self._pending = dict.fromkeys(self._pending)
+
+
+    def _attach_views(self, buffer, names=None):
+        u"""take the parts dropped by _strip_views() from buffer, a view of
+        the whole file, or only those names which _detach() copied"""
+        for key, (offset, length) in self._views.items():
+            if names is None or key in names:
+                setattr(self, key, buffer[offset:offset + length])
+        if names is not None and '_raw' in names:
+            self._raw = buffer[self.offset:self.offset + len(self._raw)]
+        if names is not None and 'chara_data' not in names:
+            return
+        for info in self.list_info['lstInfo']:
+            if info['name'] in self._pending:
+                start = info['pos']
+                self._pending[info['name']] = self.chara_data[start:start + info['size']]
+
+
+    def __getstate__(self):
+        # memoryviews can not be pickled. The original span is left out,
+        # the receiver can attach its own view of it (see KoikatuSaveData).
+        state = dict(vars(self))
+        for key, value in state.items():
+            if isinstance(value, memoryview):
+                state[key] = value.tobytes()
+        state['_pending'] = {key: bytes(value) if value is not None else None
+                             for key, value in self._pending.items()}
+        state['_raw'] = None
+        return state
+
+
+    def _read_info(self, name, data):
+        if name == 'Custom':
+            self._read_custom(data)
+        elif name == 'Coordinate':
+            self._read_coordinate(data)
+        elif name == 'Parameter':
+            self._read_parameter(data)
+        elif name == 'Status':
+            self._read_status(data)
+        elif name == 'KKEx':
+            self._read_kkex(data)
+
+
+    def _decode(self, name):
+        if name in self._pending:
+            self._read_info(name, self._pending.pop(name))
 
-    def _pack_chardata(self):
-        return self.chara_data
+
+    def _read_list_info(self, data):
+        # lstInfo is not extended, only its dicts are updated
+        return self.codec.unpack(data, use_list=False)
 
 
     def _read_custom(self, data):
-        data_stream = io.BytesIO(data)
+        data_stream = BufferReader(data)
         length = self._read_int(data_stream)
-        self.face = msgpack.unpackb(data_stream.read(length), encoding='ascii')
+        self._face = self.codec.unpack(data_stream.view(length), hooks=True)
         length = self._read_int(data_stream)
-        self.body = msgpack.unpackb(data_stream.read(length), encoding='ascii')
+        self._body = self.codec.unpack(data_stream.view(length), hooks=True)
         length = self._read_int(data_stream)
-        self.hair = msgpack.unpackb(data_stream.read(length), encoding='ascii')
+        self._hair = self.codec.unpack(data_stream.view(length), hooks=True)
 
 
     def _pack_custom(self):
-        face_s = msgpack.packb(self.face, use_single_float=True, use_bin_type=True)
-        body_s = msgpack.packb(self.body, use_single_float=True, use_bin_type=True)
-        hair_s = msgpack.packb(self.hair, use_single_float=True, use_bin_type=True)
-        data = [
-            struct.pack("i", len(face_s)),
-            face_s,
-            struct.pack("i", len(body_s)),
-            body_s,
-            struct.pack("i", len(hair_s)),
-            hair_s
-        ]
-        return b"".join(data)
+        face_s = self.codec.pack(self.face)
+        body_s = self.codec.pack(self.body)
+        hair_s = self.codec.pack(self.hair)
+        out = BufferWriter()
+        for value_s in (face_s, body_s, hair_s):
+            out.pack(INT, len(value_s))
+            out.write(value_s)
+        return out.getvalue()
 
 
     def _read_coordinate(self, data):
-        self.coordinates = []
-        for coordinate_data in msgpack.unpackb(data):
+        self._coordinates = []
+        # a list of bin, kept raw (bytes) for old msgpack too
+        for coordinate_data in self.codec.unpack(data, use_list=False, raw=True):
             coordinate = {}
-            data_stream = io.BytesIO(coordinate_data)
+            data_stream = BufferReader(coordinate_data)
             length = self._read_int(data_stream)
-            coordinate["clothes"] = msgpack.unpackb(data_stream.read(length), encoding='ascii')
+            coordinate["clothes"] = self.codec.unpack(data_stream.view(length), hooks=True)
             length = self._read_int(data_stream)
-            coordinate["accessory"] = msgpack.unpackb(data_stream.read(length), encoding='ascii')
+            coordinate["accessory"] = self.codec.unpack(data_stream.view(length), hooks=True)
             makeup = self._read_byte(data_stream)
             coordinate["enableMakeup"] = True if makeup != 0 else False
             length = self._read_int(data_stream)
-            coordinate["makeup"] = msgpack.unpackb(data_stream.read(length), encoding='ascii')
-            self.coordinates.append(coordinate)
+            coordinate["makeup"] = self.codec.unpack(data_stream.view(length), hooks=True)
+            self._coordinates.append(coordinate)
 
 
     def _pack_coordinate(self):
         data = []
         for i in self.coordinates:
-            cloth_s = msgpack.packb(i["clothes"], use_single_float=True, use_bin_type=True)
-            accessory_s = msgpack.packb(i["accessory"], use_single_float=True, use_bin_type=True)
-            makeup_s = msgpack.packb(i["makeup"], use_single_float=True, use_bin_type=True, strict_types=True)
-            coordinate = [
-                struct.pack("i", len(cloth_s)),
-                cloth_s,
-                struct.pack("i", len(accessory_s)),
-                accessory_s,
-                struct.pack("b", 1) if i["enableMakeup"] else struct.pack("b", 0),
-                struct.pack("i", len(makeup_s)),
-                makeup_s
-            ]
-            data.append(b"".join(coordinate))
-        return msgpack.packb(data, use_bin_type=True)
+            cloth_s = self.codec.pack(i["clothes"])
+            accessory_s = self.codec.pack(i["accessory"])
+            makeup_s = self.codec.pack(i["makeup"], strict_types=True)
+            coordinate = BufferWriter()
+            coordinate.pack(INT, len(cloth_s))
+            coordinate.write(cloth_s)
+            coordinate.pack(INT, len(accessory_s))
+            coordinate.write(accessory_s)
+            coordinate.pack(BYTE, 1 if i["enableMakeup"] else 0)
+            coordinate.pack(INT, len(makeup_s))
+            coordinate.write(makeup_s)
+            data.append(bytes(coordinate.getvalue()))
+        return self.codec.pack(data, single_float=False)
 
 
     def _read_parameter(self, data):
-        self.parameter = msgpack.unpackb(data, encoding='utf8')
+        self.parameter = self.codec.unpack(data)
 
 
     def _pack_parameter(self):
-        return msgpack.packb(self.parameter, use_single_float=True, use_bin_type=True)
+        return self.codec.pack(self.parameter)
 
 
     def _read_status(self, data):
-        self.status = msgpack.unpackb(data, encoding='utf8')
+        self._status = self.codec.unpack(data)
 
 
     def _pack_status(self):
-        return msgpack.packb(self.status, use_single_float=True, use_bin_type=True)
+        return self.codec.pack(self.status)
 
     def _read_kkex(self, data):
-        self.kkex = msgpack.unpackb(data, encoding='utf8')
+        self._kkex = self.codec.unpack(data)
 
     def _pack_kkex(self):
-        return msgpack.packb(self.kkex, use_single_float=True, use_bin_type=True)
+        return self.codec.pack(self.kkex)
 
 
     def _read_additional(self, data):
+        chunk_start = data.offset + data.tell()
         chunk = data.read()
 
         start = chunk.find(b'Idle')
@@ -465,7 +905,9 @@ class KoikatuCharacter:
         # -1 is length byte of 'Idle'
         self.before_additional = chunk[0:start-1]
 
-        stream = io.BytesIO(chunk[start + len('Idle'):])
+        stream = BufferReader(chunk, chunk_start)
+        stream.seek(start + len('Idle'))
+        self._offsets['additional.Idle'] = stream.offset + stream.tell()
         value = self._read_int(stream)
 
         self.additional_keys.append('Idle')
@@ -477,40 +919,49 @@ class KoikatuCharacter:
                 stream.seek(-1, 1)
                 break
             key = stream.read(len_).decode('ascii')
+            self._offsets[f'additional.{key}'] = stream.offset + stream.tell()
             value = self._read_int(stream)
             self.additional_keys.append(key)
             self.additional[key] = value
 
-        self.ac['houshi'] = stream.read(4)
+        self._read_ac(stream, 'houshi')
         if self.master_version >= "0.0.7":
+            self._offsets['eventAfterDay'] = stream.offset + stream.tell()
             self.eventAfterDay = self._read_int(stream)
+            self._offsets['isFirstGirlfriend'] = stream.offset + stream.tell()
             self.isFirstGirlfriend = self._read_byte(stream)
 
         if self.master_version >= "1.0.1":
+            self._offsets['intimacy'] = stream.offset + stream.tell()
             self.intimacy = self._read_int(stream)
             
         self.after_additional = stream.read()
 
     def _pack_additional(self):
-        data = [self.before_additional]
+        out = BufferWriter()
+        out.write(self.before_additional)
 
-        for key in self.additional_keys:
-            data.append(self._pack_byte(len(key)))
-            data.append(key.encode())
-            data.append(self._pack_int(self.additional[key]))
+        # keys set only in the additional dict go last
+        keys = [key for key in self.additional_keys if key in self.additional]
+        keys += [key for key in self.additional if key not in keys]
+        for key in keys:
+            key_s = key.encode()
+            out.pack(BYTE, len(key_s))
+            out.write(key_s)
+            out.pack(INT, self.additional[key])
 
-        data.append(self.ac['houshi'])
+        out.write(self.ac['houshi'])
 
         if self.sex == 1:
             if self.master_version >= "0.0.7":
-                data.append(self._pack_int(int(self.eventAfterDay)))
-                data.append(self._pack_byte(self.isFirstGirlfriend))
+                out.pack(INT, int(self.eventAfterDay))
+                out.pack(BYTE, self.isFirstGirlfriend)
 
             if self.master_version >= "1.0.1":
-                data.append(self._pack_int(int(self.intimacy)))
+                out.pack(INT, int(self.intimacy))
 
-        data.append(self.after_additional)
-        return b''.join(data)
+        out.write(self.after_additional)
+        return out.getvalue()
 
 
     def _read_utf8_string(self, data):
@@ -526,56 +977,37 @@ class KoikatuCharacter:
 
 
     def _read_byte(self, data):
-        return struct.unpack('b', data.read(1))[0]
+        return data.unpack(BYTE)[0]
 
 
     def _pack_byte(self, size):
-        return struct.pack('b', size)
+        return BYTE.pack(size)
 
 
     def _read_int(self, data, endian='<'):
-        return struct.unpack(endian + 'i', data.read(4))[0]
+        return data.unpack(INT if endian == '<' else INT_BE)[0]
 
 
     def _pack_int(self, size, endian='<'):
-        return struct.pack(endian + 'i', size)
+        return (INT if endian == '<' else INT_BE).pack(size)
 
 
     def _read_png(self, data):
+        start = data.tell()
         signature = data.read(8) # PNG file signature
         assert signature == b'\x89\x50\x4e\x47\x0d\x0a\x1a\x0a'
 
-        ihdr = data.read(25)
-
-        # read IDAT chunk
-        idat_chunks = []
-        len_ = self._read_int(data, '!')
-        while len_ > 0:
-            idat_type = data.read(4)
-            assert idat_type == b'IDAT'
-
-            idat_data = data.read(len_)
-            idat_crc = data.read(4)
-            idat_chunks.append((len_, idat_type, idat_data, idat_crc))
-
+        # skip chunks (IHDR, IDAT, ancillary ones) by their length up to IEND
+        while True:
             len_ = self._read_int(data, '!')
+            chunk_type = data.read(4)
+            data.seek(len_ + 4, 1) # chunk data and crc
+            if chunk_type == b'IEND':
+                break
 
-        # read IEND chunk
-        iend_len = len_
-        iend = data.read(4)
-        assert iend == b'IEND'
-
-        iend_crc = data.read(4)
-
-        data = [signature, ihdr]
-        for idat_chunk in idat_chunks:
-            data += [
-                self._pack_int(idat_chunk[0], '!'),
-                idat_chunk[1], idat_chunk[2], idat_chunk[3]
-            ]
-        data += [self._pack_int(iend_len, '!'), iend, iend_crc]
-
-        return b"".join(data)
+        size = data.tell() - start
+        data.seek(start)
+        return data.view(size)
 
 
 if __name__ == '__main__':
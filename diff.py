@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import struct
+import sys
+import zlib
+from collections import namedtuple
+
+import msgpack
+
+from export import flatten
+from save_data import CHARA_HEADER, KoikatuSaveData
+
+CharacterChange = namedtuple('CharacterChange', ('old', 'new', 'fields'))
+
+# header changes, (old, new) seats of added/removed characters and the
+# field changes of the characters in both saves
+SaveDiff = namedtuple('SaveDiff', ('header', 'added', 'removed', 'moved', 'changed'))
+
+DELTA_MAGIC = b'KKDELTA\x01'
+# old size, new size, hash of the old and of the new save
+DELTA_HEADER = struct.Struct('<QQ16s16s')
+COPY = struct.Struct('<cQQ')
+INSERT = struct.Struct('<cQ')
+
+# segments of equal length are compared down to blocks of this size
+BLOCK_SIZE = 64
+# bytes at the start of a character which find its old version, these
+# include the beginning of the portrait
+ANCHOR_SIZE = 4096
+
+
+def _hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _custom_block(chara):
+    # the encoded Custom block, without decoding it
+    for info in chara.list_info['lstInfo']:
+        if info['name'] == 'Custom':
+            return chara.chara_data[info['pos']:info['pos'] + info['size']]
+    return b''
+
+
+def identity(chara):
+    u"""(lastname, firstname, nickname, hash of Custom) of a character"""
+    return (chara.lastname, chara.firstname, chara.nickname, _hash(_custom_block(chara)).hex())
+
+
+def match_characters(old, new):
+    u"""[(old seat, new seat)] of the same characters in two lists
+
+    Characters are matched by identity(), then the rest by their names
+    alone and by their appearance alone, so that a renamed character or one
+    with a changed appearance is still found.
+    """
+    pairs = []
+    for key in (identity, lambda chara: identity(chara)[:3], lambda chara: identity(chara)[3]):
+        seats = {}
+        matched_old = {i for i, _ in pairs}
+        matched_new = {j for _, j in pairs}
+        for i, chara in enumerate(old):
+            if i not in matched_old:
+                seats.setdefault(key(chara), []).append(i)
+        for j, chara in enumerate(new):
+            found = seats.get(key(chara))
+            if j not in matched_new and found:
+                pairs.append((found.pop(0), j))
+    return sorted(pairs, key=lambda pair: pair[1])
+
+
+def diff_characters(old, new):
+    u"""[(field, old value, new value)] of the differences of two characters
+
+    Fields are those of export.flatten() (parameter keys, status, ac levels,
+    additional counters), 'Custom' with the hashes of the appearance and
+    'KKEx.<plugin>' for the extended data of each plugin.
+    """
+    changes = []
+    a, b = flatten(old), flatten(new)
+    for name in list(a) + [name for name in b if name not in a]:
+        if a.get(name) != b.get(name):
+            changes.append((name, a.get(name), b.get(name)))
+
+    custom = identity(old)[3], identity(new)[3]
+    if custom[0] != custom[1]:
+        changes.append(('Custom', *custom))
+
+    a = old.kkex if 'KKEx' in old.info_order else None
+    b = new.kkex if 'KKEx' in new.info_order else None
+    a, b = a or {}, b or {}
+    for key in list(a) + [key for key in b if key not in a]:
+        if key not in a or key not in b or msgpack.packb(a[key]) != msgpack.packb(b[key]):
+            changes.append((f'KKEx.{key}', a.get(key), b.get(key)))
+    return changes
+
+
+def diff_saves(old, new):
+    u"""SaveDiff of two KoikatuSaveData, best loaded with lazy=True"""
+    header = []
+    for name in ('version_num', 'school'):
+        if getattr(old, name) != getattr(new, name):
+            header.append((name, getattr(old, name), getattr(new, name)))
+
+    pairs = match_characters(old.characters, new.characters)
+    changed = []
+    for i, j in pairs:
+        fields = diff_characters(old.characters[i], new.characters[j])
+        if fields:
+            changed.append(CharacterChange(i, j, fields))
+    matched_old = {i for i, _ in pairs}
+    matched_new = {j for _, j in pairs}
+    return SaveDiff(
+        header,
+        [j for j in range(len(new.characters)) if j not in matched_new],
+        [i for i in range(len(old.characters)) if i not in matched_old],
+        [(i, j) for i, j in pairs if i != j],
+        changed,
+    )
+
+
+class _Ops:
+    u"""COPY and INSERT operations, adjacent ones merged"""
+    def __init__(self):
+        self.out = bytearray()
+        self._copy = None
+        self._insert = bytearray()
+
+
+    def copy(self, offset, length):
+        if length == 0:
+            return
+        self._flush_insert()
+        if self._copy is not None and sum(self._copy) == offset:
+            self._copy[1] += length
+            return
+        self._flush_copy()
+        self._copy = [offset, length]
+
+
+    def insert(self, data):
+        if len(data) == 0:
+            return
+        self._flush_copy()
+        self._insert += data
+
+
+    def finish(self):
+        self._flush_copy()
+        self._flush_insert()
+        return bytes(self.out)
+
+
+    def _flush_copy(self):
+        if self._copy is not None:
+            self.out += COPY.pack(b'C', *self._copy)
+            self._copy = None
+
+
+    def _flush_insert(self):
+        if self._insert:
+            self.out += INSERT.pack(b'I', len(self._insert))
+            self.out += self._insert
+            self._insert = bytearray()
+
+
+def _segments(data):
+    # header and characters. A header inside a PNG only splits a segment,
+    # the delta is still exact.
+    starts = [0]
+    pos = data.find(CHARA_HEADER)
+    while pos != -1:
+        if pos > 0:
+            starts.append(pos)
+        pos = data.find(CHARA_HEADER, pos + 1)
+    return list(zip(starts, starts[1:] + [len(data)]))
+
+
+def _common_prefix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a, b, limit):
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _diff_equal_length(ops, old, start, new, nstart, length):
+    # halves which are equal are copied, others are split further
+    if old[start:start + length] == new[nstart:nstart + length]:
+        ops.copy(start, length)
+    elif length <= BLOCK_SIZE:
+        ops.insert(new[nstart:nstart + length])
+    else:
+        half = length // 2
+        _diff_equal_length(ops, old, start, new, nstart, half)
+        _diff_equal_length(ops, old, start + half, new, nstart + half, length - half)
+
+
+def _diff_segment(ops, old, span, new, nspan):
+    start, end = span
+    nstart, nend = nspan
+    if end - start == nend - nstart:
+        # e.g. status values changed in place
+        _diff_equal_length(ops, old, start, new, nstart, end - start)
+        return
+    a, b = old[start:end], new[nstart:nend]
+    prefix = _common_prefix(a, b)
+    suffix = _common_suffix(a, b, min(len(a), len(b)) - prefix)
+    ops.copy(start, prefix)
+    ops.insert(new[nstart + prefix:nend - suffix])
+    ops.copy(end - suffix, suffix)
+
+
+def make_delta(old, new, level=9):
+    u"""compact delta which turns the bytes of the old save into the new one
+
+    The saves are split into their characters. A character found unchanged
+    anywhere in the old save is copied from there, a changed one is compared
+    with its old version, found by its first bytes or else its seat.
+    """
+    old, new = bytes(old), bytes(new)
+    old_segments = _segments(old)
+    by_content = {_hash(old[start:end]): start for start, end in old_segments}
+    by_anchor = {}
+    for span in old_segments:
+        by_anchor.setdefault(_hash(old[span[0]:span[0] + ANCHOR_SIZE]), span)
+
+    ops = _Ops()
+    for seat, (start, end) in enumerate(_segments(new)):
+        found = by_content.get(_hash(new[start:end]))
+        if found is not None:
+            ops.copy(found, end - start)
+            continue
+        span = by_anchor.get(_hash(new[start:start + ANCHOR_SIZE]))
+        if span is None and seat < len(old_segments):
+            span = old_segments[seat]
+        if span is None:
+            ops.insert(new[start:end])
+        else:
+            _diff_segment(ops, old, span, new, (start, end))
+
+    header = DELTA_HEADER.pack(len(old), len(new), _hash(old), _hash(new))
+    return DELTA_MAGIC + header + zlib.compress(ops.finish(), level)
+
+
+def apply_delta(old, delta):
+    u"""the new save of make_delta() from the old save and the delta"""
+    if not delta.startswith(DELTA_MAGIC):
+        raise ValueError('not a save delta')
+    pos = len(DELTA_MAGIC)
+    old_size, new_size, old_hash, new_hash = DELTA_HEADER.unpack_from(delta, pos)
+    if len(old) != old_size or _hash(old) != old_hash:
+        raise ValueError('the delta is of another save')
+    ops = zlib.decompress(delta[pos + DELTA_HEADER.size:])
+
+    new = bytearray()
+    pos = 0
+    while pos < len(ops):
+        if ops[pos:pos + 1] == b'C':
+            _, offset, length = COPY.unpack_from(ops, pos)
+            new += old[offset:offset + length]
+            pos += COPY.size
+        else:
+            _, length = INSERT.unpack_from(ops, pos)
+            pos += INSERT.size
+            new += ops[pos:pos + length]
+            pos += length
+    if len(new) != new_size or _hash(new) != new_hash:
+        raise ValueError('corrupt delta')
+    return bytes(new)
+
+
+def _short(value, width=60):
+    text = repr(value)
+    return text if len(text) <= width else text[:width - 3] + '...'
+
+
+def print_diff(diff, old, new, file=sys.stdout):
+    for name, a, b in diff.header:
+        print(f'{name}: {a!r} -> {b!r}', file=file)
+    for i in diff.removed:
+        chara = old.characters[i]
+        print(f'- {i:3} {chara.lastname} {chara.firstname}', file=file)
+    for j in diff.added:
+        chara = new.characters[j]
+        print(f'+ {j:3} {chara.lastname} {chara.firstname}', file=file)
+    for i, j in diff.moved:
+        chara = new.characters[j]
+        print(f'  {i:3} -> {j:3} {chara.lastname} {chara.firstname}', file=file)
+    for change in diff.changed:
+        chara = new.characters[change.new]
+        print(f'~ {change.new:3} {chara.lastname} {chara.firstname}', file=file)
+        for name, a, b in change.fields:
+            print(f'      {name}: {_short(a)} -> {_short(b)}', file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare saves, make and apply deltas')
+    sub = parser.add_subparsers(dest='command', required=True)
+    show = sub.add_parser('show', help='print the changed characters and fields')
+    show.add_argument('old')
+    show.add_argument('new')
+    delta = sub.add_parser('delta', help='write a delta from old to new')
+    delta.add_argument('old')
+    delta.add_argument('new')
+    delta.add_argument('-o', dest='output', required=True, help='delta file')
+    apply = sub.add_parser('apply', help='write the new save of a delta')
+    apply.add_argument('old')
+    apply.add_argument('delta')
+    apply.add_argument('-o', dest='output', required=True, help='output file')
+
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        old = KoikatuSaveData(args.old, lazy=True)
+        new = KoikatuSaveData(args.new, lazy=True)
+        print_diff(diff_saves(old, new), old, new)
+        return 0
+
+    with open(args.old, 'rb') as file:
+        old = file.read()
+    if args.command == 'delta':
+        with open(args.new, 'rb') as file:
+            data = make_delta(old, file.read())
+        with open(args.output, 'wb') as out:
+            out.write(data)
+        print(f'{len(data)} bytes')
+        return 0
+
+    with open(args.delta, 'rb') as file:
+        delta = file.read()
+    try:
+        data = apply_delta(old, delta)
+    except (ValueError, zlib.error, struct.error) as e:
+        print(e, file=sys.stderr)
+        return 1
+    with open(args.output, 'wb') as out:
+        out.write(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+import argparse
+import sys
+from array import array
+from pathlib import Path
+
+from batch import find_save_files
+from save_data import iter_characters
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STATUS_FIELDS = ('feeling', 'm_love', 'h_count', 'intimacy', 'lover', 'koikatu', 'date')
+AC_KEYS = ('mune', 'kokan', 'anal', 'siri', 'tikubi', 'kokan_piston', 'anal_piston', 'houshi')
+
+# typecode of the array of each kind of column, str columns are lists
+TYPECODES = {bool: 'b', int: 'q', float: 'd'}
+
+
+def flatten(chara):
+    u"""{column: value} of the scalar values of a character
+
+    Nested parameter dicts become 'awnser.animal' and so on, lists are left
+    out. Only Parameter has to be decoded, so lazy characters will do.
+    """
+    row = {}
+
+    def add(prefix, values):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                add(f'{prefix}{key}.', value)
+            elif isinstance(value, (bool, int, float, str)):
+                row[f'{prefix}{key}'] = value
+    add('', chara.parameter)
+
+    for name in STATUS_FIELDS:
+        row[name] = getattr(chara, name)
+    for key in AC_KEYS:
+        if len(chara.ac.get(key, b'')) > 0:
+            row[f'ac.{key}'] = chara.get_ac(key)
+    for key, value in chara.additional.items():
+        row[f'additional.{key}'] = value
+    return row
+
+
+class Column:
+    u"""typed values of a column and which of them are set"""
+    def __init__(self, kind, nulls=0):
+        self.kind = kind
+        if kind is str:
+            self.values = [''] * nulls
+        else:
+            self.values = array(TYPECODES[kind], [0]) * nulls
+        self.valid = bytearray(nulls)
+
+
+    def append(self, value):
+        # e.g. an int in a float column
+        if self.kind is float and type(value) is int:
+            value = float(value)
+        elif self.kind is int and type(value) is bool:
+            value = int(value)
+        if type(value) is self.kind:
+            self.values.append(value)
+            self.valid.append(1)
+        else:
+            self.values.append(self.kind())
+            self.valid.append(0)
+
+
+    def __len__(self):
+        return len(self.valid)
+
+
+class ColumnTable:
+    u"""rows collected into typed columns
+
+    A column is created by the first row which has it, and is null in the
+    rows before. Once frozen, columns which are not in the table already
+    are ignored, which keeps the schema of a streamed Parquet file fixed.
+    """
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+        self.frozen = False
+
+
+    def append(self, row):
+        for name, value in row.items():
+            if name not in self.columns and not self.frozen:
+                self.columns[name] = Column(type(value), self.rows)
+        for name, column in self.columns.items():
+            column.append(row.get(name))
+        self.rows += 1
+
+
+    def clear(self):
+        for name, column in self.columns.items():
+            self.columns[name] = Column(column.kind)
+        self.rows = 0
+
+
+    def to_numpy(self):
+        u"""{name: array}, with a name + '.valid' mask for columns with nulls"""
+        arrays = {}
+        for name, column in self.columns.items():
+            if column.kind is str:
+                arrays[name] = numpy.array(column.values, dtype=str)
+            else:
+                arrays[name] = numpy.frombuffer(column.values, dtype=column.values.typecode)
+                if column.kind is bool:
+                    arrays[name] = arrays[name].astype(bool)
+            if not all(column.valid):
+                arrays[f'{name}.valid'] = numpy.frombuffer(column.valid, dtype=numpy.uint8).astype(bool)
+        return arrays
+
+
+    def schema(self):
+        types = {bool: pyarrow.bool_(), int: pyarrow.int64(),
+                 float: pyarrow.float64(), str: pyarrow.string()}
+        return pyarrow.schema([(name, types[column.kind])
+                               for name, column in self.columns.items()])
+
+
+    def to_arrow(self, schema):
+        arrays = []
+        for field in schema:
+            column = self.columns[field.name]
+            values = column.values
+            if column.kind is bool:
+                values = [bool(v) for v in values]
+            mask = [not v for v in column.valid] if not all(column.valid) else None
+            arrays.append(pyarrow.array(values, type=field.type, mask=mask))
+        return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def rows(files):
+    u"""flattened characters of the save files, one by one"""
+    for filename in files:
+        for number, chara in enumerate(iter_characters(filename, lazy=True)):
+            row = {'save': str(filename), 'number': number, 'offset': chara.offset}
+            row.update(flatten(chara))
+            yield row
+
+
+def export(files, out, format=None, batch_size=4096):
+    u"""write all characters of the save files to a Parquet or .npz file
+
+    Parquet (with pyarrow) is written in row groups of batch_size, so memory
+    does not grow with the number of characters, and its columns are those
+    of the first batch. The .npz (with numpy) has a typed array per column.
+    Returns the number of characters.
+    """
+    if format is None and Path(out).suffix in ('.npz', '.parquet'):
+        format = Path(out).suffix[1:]
+    format = format or ('parquet' if pyarrow is not None else 'npz')
+    if format == 'parquet' and pyarrow is None:
+        raise RuntimeError('pyarrow is required for Parquet output')
+    if format == 'npz' and numpy is None:
+        raise RuntimeError('numpy is required for .npz output')
+
+    table = ColumnTable()
+    count = 0
+    if format == 'npz':
+        for row in rows(files):
+            table.append(row)
+            count += 1
+        with open(out, 'wb') as file:
+            numpy.savez_compressed(file, **table.to_numpy())
+        return count
+
+    writer = None
+    try:
+        for row in rows(files):
+            table.append(row)
+            count += 1
+            if table.rows >= batch_size:
+                writer = _write_batch(writer, table, out)
+        if table.rows > 0 or writer is None:
+            writer = _write_batch(writer, table, out)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def _write_batch(writer, table, out):
+    if writer is None:
+        table.frozen = True
+        writer = pyarrow.parquet.ParquetWriter(str(out), table.schema())
+    writer.write_table(table.to_arrow(writer.schema))
+    table.clear()
+    return writer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export the characters of saves as a table')
+    parser.add_argument('paths', nargs='+', help='save files, directories or glob patterns')
+    parser.add_argument('-o', dest='output', required=True, help='output file')
+    parser.add_argument('--format', choices=('parquet', 'npz'), default=None,
+                        help='default: by the output suffix, else parquet if pyarrow '
+                             'is installed, else npz')
+    parser.add_argument('--batch-size', type=int, default=4096,
+                        help='characters per Parquet row group')
+
+    args = parser.parse_args()
+
+    files = find_save_files(args.paths)
+    try:
+        count = export(files, Path(args.output), args.format, args.batch_size)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(f'{count} characters of {len(files)} saves')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
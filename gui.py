@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 import argparse
 import io
+import multiprocessing
+import queue
 import shutil
 import sys
+import threading
 import traceback
 from pathlib import Path
 import winreg
@@ -11,14 +14,17 @@ import winreg
 import tkinter as tk
 import tkinter.ttk as ttk
 from tkinter.filedialog import askopenfilename
+from tkinter.messagebox import showerror
 
 from PIL import Image, ImageTk
-from scframe import VerticalScrolledFrame
+from scframe import VirtualScrolledList
 
+from card_index import DEFAULT_PATH as CARD_INDEX_PATH, CardIndex
 from character import KoikatuCharacter
 from save_data import KoikatuSaveData
 from resource import Resource as RM
 from status import StatusPanel
+from thumbnail import ThumbnailCache
 
 class PropertyPanel(ttk.Frame):
 
@@ -190,19 +196,20 @@ class PropertyPanel(ttk.Frame):
             self._intellect.set(character.intelligence)
             self._physical.set(character.strength)
             self._hentai.set(character.ero)
-        
 
-        self.personality = character.personality
-        self.weak_point = character.weak_point
+        elif character.sex == 1:
+            self._sex.set([RM.res('male'), RM.res('female')][character.sex])
+            self.personality = character.personality
+            self.weak_point = character.weak_point
 
-        for key in self._answers:
-            self._answers[key].set(character.answers[key])
+            for key in self._answers:
+                self._answers[key].set(character.answers[key])
 
-        for key in self._denials:
-            self._denials[key].set(character.denials[key])
+            for key in self._denials:
+                self._denials[key].set(character.denials[key])
 
-        for key in self._attributes:
-                self._attributes[key].set(character.attributes.setdefault(key,False))
+            for key in self._attributes:
+                    self._attributes[key].set(character.attributes.setdefault(key,False))
 
 
     def _make_boolean_prop(self, frame, name, value, i, cols):
@@ -223,12 +230,12 @@ class CharacterPanel(ttk.Frame):
                          *args, **kwargs)
         self.app = app
         self.parent = parent
+        # the panel is reused for other characters, see show()
         self._character = character
-        self.dirty = False
-
-        png = Image.open(io.BytesIO(character.png))
-        self.image = ImageTk.PhotoImage(png)
+        self._image_key = None
 
+        # placeholder until the thumbnail is loaded
+        self.image = app.placeholder
         self.photo = tk.Label(self,
                               image=self.image,
                               width=self.image.width(),
@@ -249,69 +256,211 @@ class CharacterPanel(ttk.Frame):
         self._load_btn.grid(row=2, column=1, sticky='W', pady=4)
 
 
-    @property
-    def character(self):
+    def show(self, character):
+        u"""show character in the panel, to be edited until commit()"""
+        self._character = character
+        self.property_panel.update_character(character)
+        if character.sex == 1:
+            self.status_panel.update_character(character)
+        self.image = self.app.placeholder
+        self.photo.config(image=self.image)
+        self._request_image(character.png)
+
+    def commit(self):
+        u"""write the values of the widgets into the character
+
+        All values are read before any is written, so a value which is not
+        a number raises ValueError and leaves the character unchanged.
+        """
         chara = self._character
         panel = self.property_panel
 
-        chara.firstname = panel.firstname
-        chara.lastname = panel.lastname
-        chara.nickname = panel.nickname
+        values = {
+            'firstname': panel.firstname,
+            'lastname': panel.lastname,
+            'nickname': panel.nickname,
+        }
+        ac = {}
         if chara.sex == 0:
-            chara.intelligence = panel.intellect
-            chara.strength = panel.physical
-            chara.ero = panel.hentai
+            values['intelligence'] = int(panel.intellect)
+            values['strength'] = int(panel.physical)
+            values['ero'] = int(panel.hentai)
 
         elif chara.sex == 1:
-            chara.personality = panel.personality
-            chara.weak_point = panel.weak_point
-            chara.answers = self.property_panel.answers
-            chara.denials = self.property_panel.denials
-            chara.attributes = self.property_panel.attributes
+            values['personality'] = panel.personality
+            values['weak_point'] = panel.weak_point
+            values['answers'] = panel.answers
+            values['denials'] = panel.denials
+            values['attributes'] = panel.attributes
 
             panel = self.status_panel
-            chara.feeling = panel.feeling
-            chara.m_love  = panel.m_love
-            chara.h_count = panel.h_count
-            chara.koikatu = panel.koikatu
-            chara.lover = panel.relation
-            chara.date = panel.date
-            chara.intimacy = panel.intimacy
-
-            ac = [
+            values['feeling'] = panel.feeling
+            values['m_love'] = panel.m_love
+            values['h_count'] = panel.h_count
+            values['koikatu'] = panel.koikatu
+            values['lover'] = panel.relation
+            values['date'] = panel.date
+            values['intimacy'] = panel.intimacy
+
+            names = [
                 'mune', 'kokan', 'anal', 'siri', 'tikubi',
                 'kokan_piston', 'anal_piston', 'houshi'
             ]
-            for name in ac:
-                chara.set_ac(name, panel.ac(name))
+            for name in names:
+                ac[name] = panel.ac(name)
 
-        self.dirty = True
+        for name, value in values.items():
+            setattr(chara, name, value)
+        for name, value in ac.items():
+            chara.set_ac(name, value)
         return chara
 
     def _update_character(self, character):
-        self._character.custom = character.custom
-        self._character.coordinates = character.coordinates
-        self._character.parameter = character.parameter
-        self._character.status = character.status
-        self._character.png_length = character.png_length
-        self._character.png = character.png
-        self.dirty = True
-
-        png = Image.open(io.BytesIO(character.png))
-        self.image = ImageTk.PhotoImage(png)
-        self.photo.config(image=self.image)
+        self._character.replace_card(character)
+
+        self._request_image(character.png)
 
         self.property_panel.update_character(self._character)
 
+    def _request_image(self, png):
+        # set first, a thumbnail in memory is passed to _set_image() before
+        # request() returns
+        self._image_key = self.app.thumbnails.key(png)
+        self.app.thumbnails.request(png, self._set_image)
+
+    def _set_image(self, key, image):
+        # a later card may have been loaded meanwhile
+        if key != self._image_key:
+            return
+        self.image = ImageTk.PhotoImage(image)
+        self.photo.config(image=self.image)
+
     def _open_dialog(self):
-        name = askopenfilename(filetype=[("koikatu card", "*.png")],
-                               initialdir=self.app.card_dir)
-        if name is not None:
-            with open(name, 'rb') as infile:
-                chara = KoikatuCharacter(infile, True)
-                self._update_character(chara)
+        self.app.pick_card(self._character.sex, self._load_card)
+
+
+    def _load_card(self, name):
+        with open(name, 'rb') as infile:
+            chara = KoikatuCharacter(infile, True, lazy=True)
+            self._update_character(chara)
+
+
+class CardPicker(tk.Toplevel):
+    u"""searchable list of the indexed cards of the card folder
+
+    The cards come from the CardIndex filled by App.scan_cards(), so the
+    list is shown at once and grows while the folder is scanned.
+    """
+    def __init__(self, app, sex, on_pick):
+        super().__init__(app.root)
+        self.title('Load Character Card')
+        self.app = app
+        self.sex = sex
+        self.on_pick = on_pick
+        self._index = CardIndex(app.card_index_path)
+        self._refresh_id = None
+        self.preview = None
+
+        self._text = tk.StringVar()
+        self._text.trace_add('write', lambda *args: self._schedule_refresh())
+        entry = ttk.Entry(self, textvariable=self._text, width=40)
+        entry.grid(row=0, column=0, sticky='WE', padx=2, pady=2)
+        self._status = ttk.Label(self)
+        self._status.grid(row=0, column=1, sticky='W', padx=2)
+
+        self._tree = ttk.Treeview(self, columns=('name', 'nickname', 'file'),
+                                  show='headings', selectmode='browse', height=20)
+        for column, text, width in (('name', 'Name', 160), ('nickname', 'Nickname', 100),
+                                    ('file', 'File', 240)):
+            self._tree.heading(column, text=text)
+            self._tree.column(column, width=width)
+        scrollbar = ttk.Scrollbar(self, orient='vertical', command=self._tree.yview)
+        self._tree.config(yscrollcommand=scrollbar.set)
+        self._tree.grid(row=1, column=0, sticky='NSWE', padx=2)
+        scrollbar.grid(row=1, column=1, sticky='NSW')
+        self._tree.bind('<<TreeviewSelect>>', lambda event: self._show_preview())
+        self._tree.bind('<Double-1>', lambda event: self._pick())
+        self._tree.bind('<Return>', lambda event: self._pick())
+        entry.bind('<Return>', lambda event: self._pick())
+
+        self._photo = tk.Label(self)
+        self._photo.grid(row=1, column=2, sticky='N', padx=2)
+
+        btn_frame = ttk.Frame(self)
+        ttk.Button(btn_frame, text='Cancel', command=self.destroy).pack(side='right')
+        ttk.Button(btn_frame, text='Open', command=self._pick).pack(side='right')
+        ttk.Button(btn_frame, text='Browse...', command=self._browse).pack(side='left')
+        btn_frame.grid(row=2, column=0, columnspan=3, sticky='WE', padx=2, pady=2)
+
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(1, weight=1)
+        self.protocol('WM_DELETE_WINDOW', self.destroy)
+        entry.focus_set()
+        self.refresh()
+
+
+    def destroy(self):
+        self._index.close()
+        if self.app.picker is self:
+            self.app.picker = None
+        super().destroy()
+
+
+    def refresh(self):
+        self._refresh_id = None
+        selected = self._tree.selection()
+        self._tree.delete(*self._tree.get_children())
+        for path, lastname, firstname, nickname, sex, personality in self._index.find(
+                self._text.get(), self.sex, self.app.card_dir):
+            name = Path(path).relative_to(self.app.card_dir)
+            self._tree.insert('', 'end', iid=path, values=(f'{lastname} {firstname}', nickname, name))
+        if selected and self._tree.exists(selected[0]):
+            self._tree.selection_set(selected[0])
+
+
+    def show_progress(self, done, total):
+        if done is None:
+            self._status.config(text='')
         else:
-            self.quit()
+            self._status.config(text=f'Indexing {done} / {total}')
+
+
+    def _schedule_refresh(self):
+        # once the typing stops
+        if self._refresh_id is not None:
+            self.after_cancel(self._refresh_id)
+        self._refresh_id = self.after(150, self.refresh)
+
+
+    def _show_preview(self):
+        selected = self._tree.selection()
+        png = self._index.preview(selected[0]) if selected else None
+        if png is None:
+            self.preview = None
+            self._photo.config(image='')
+            return
+        self.preview = ImageTk.PhotoImage(Image.open(io.BytesIO(png)))
+        self._photo.config(image=self.preview)
+
+
+    def _pick(self):
+        selected = self._tree.selection()
+        if not selected:
+            children = self._tree.get_children()
+            if len(children) != 1:
+                self.bell()
+                return
+            selected = children
+        self.destroy()
+        self.on_pick(selected[0])
+
+
+    def _browse(self):
+        name = askopenfilename(parent=self, filetype=[("koikatu card", "*.png")],
+                               initialdir=self.app.card_dir)
+        if name:
+            self.destroy()
+            self.on_pick(name)
 
 
 class App:
@@ -319,29 +468,43 @@ class App:
         self.root = root
         self.filename = filename
         self.out_filename = out_filename
-        self.save_data = KoikatuSaveData(filename)
+        # loaded in a thread, characters is filled as they are decoded
+        self.save_data = None
+        self.characters = []
+        self._events = queue.Queue()
+        self.thumbnails = ThumbnailCache()
+        self.thumbnails.attach(self.root)
+        width, height = self.thumbnails.size
+        self.placeholder = tk.PhotoImage(width=width, height=height)
         try:
             self.card_dir=get_default_chara_folder()
         except:
             self.card_dir=Path.cwd()
+        # the index paths start with the card folder, see CardPicker
+        self.card_dir = Path(self.card_dir).resolve()
+        self.card_index_path = CARD_INDEX_PATH
+        self.picker = None
+        self._scanning = False
 
         style = ttk.Style()
         style.configure('.', padding='2 4 2 4')
-        frame = VerticalScrolledFrame(self.root)
-
-        self.panels = []
-        row_count = 0
-        for chara in self.save_data.characters:
-                panel = CharacterPanel(self, frame.interior, chara)
-                panel.grid(row=int(row_count/2),column = int(row_count%2))
-                self.panels.append(panel)
-                row_count+=1
+        # panels only for the visible characters, reused while scrolling
+        frame = VirtualScrolledList(self.root, 0,
+                                    self._create_panel, self._show_panel, self._hide_panel,
+                                    kind=self._panel_kind, columns=2,
+                                    row_height=355, column_width=720)
+        self.character_list = frame
 
         btn_frame = ttk.Frame(self.root)
-        save_btn = ttk.Button(btn_frame, text='Save & Quit', command=self.save_and_quit)
+        self._progress = ttk.Progressbar(btn_frame, length=300)
+        self._progress_text = ttk.Label(btn_frame)
+        self._save_btn = ttk.Button(btn_frame, text='Save & Quit', command=self.save_and_quit,
+                                    state='disabled')
         quit_btn = ttk.Button(btn_frame, text='Quit', command=self.quit)
         quit_btn.pack(side='right', pady=2)
-        save_btn.pack(side='right', pady=2)
+        self._save_btn.pack(side='right', pady=2)
+        self._progress.pack(side='left', padx=4, pady=2)
+        self._progress_text.pack(side='left', padx=4, pady=2)
 
 
         frame.grid(row=0, column=0)
@@ -362,25 +525,161 @@ class App:
             frame.canvas.config(height=fh)
         self.root.bind('<Configure>', _configure)
 
+        self._progress_text.config(text=f'Loading {Path(filename).name}')
+        threading.Thread(target=self._load, daemon=True).start()
+        self.scan_cards()
+        self._poll_events()
+
+
+    def _load(self):
+        # worker thread, the results are handled by _poll_events()
+        def progress(chara, count, total):
+            self._events.put(('character', chara, count, total))
+        try:
+            save_data = KoikatuSaveData(self.filename, lazy=True, progress=progress)
+            self._events.put(('loaded', save_data))
+        except Exception:
+            self._events.put(('error', traceback.format_exc()))
+
+
+    def _poll_events(self):
+        count = len(self.characters)
+        while True:
+            try:
+                event, *args = self._events.get_nowait()
+            except queue.Empty:
+                break
+            if event == 'character':
+                chara, done, total = args
+                self.characters.append(chara)
+                self._progress.config(maximum=total, value=done)
+                self._progress_text.config(text=f'Loading {done} / {total}')
+            elif event == 'loaded':
+                self.save_data = args[0]
+                self._show_progress(None)
+                self._save_btn.config(state='normal')
+            elif event == 'cards':
+                done, total = args
+                self._scanning = done is not None
+                if self.picker is not None:
+                    self.picker.show_progress(done, total)
+                    self.picker.refresh()
+            elif event == 'saved':
+                self.root.destroy()
+                return
+            elif event == 'error':
+                showerror('Koikatu Save data editor', args[0])
+                self._show_progress(None)
+                if self.save_data is None:
+                    self.root.destroy()
+                    return
+                self._save_btn.config(state='normal')
+        if len(self.characters) != count:
+            # fill in the panels of the characters decoded meanwhile
+            self.character_list.count = len(self.characters)
+            self.character_list.refresh()
+        self.root.after(50, self._poll_events)
+
+
+    def scan_cards(self):
+        u"""index new and changed cards of the card folder in a thread"""
+        if self._scanning:
+            return
+        self._scanning = True
+        threading.Thread(target=self._scan_cards, daemon=True).start()
+
+
+    def _scan_cards(self):
+        # worker thread with its own connection, see _poll_events()
+        def progress(done, total):
+            self._events.put(('cards', done, total))
+        try:
+            with CardIndex(self.card_index_path) as index:
+                index.scan(self.card_dir, progress=progress)
+        except Exception:
+            traceback.print_exc()
+        self._events.put(('cards', None, None))
+
+
+    def pick_card(self, sex, on_pick):
+        u"""let the user choose a card of sex, on_pick(path) is called with it"""
+        if self.picker is not None:
+            self.picker.destroy()
+        self.picker = CardPicker(self, sex, on_pick)
+        # files changed since the last scan
+        self.scan_cards()
+
+
+    def _show_progress(self, text):
+        if text is None:
+            self._progress.stop()
+            self._progress.pack_forget()
+            self._progress_text.pack_forget()
+        else:
+            self._progress_text.config(text=text)
+            self._progress.config(mode='indeterminate')
+            self._progress.pack(side='left', padx=4, pady=2)
+            self._progress_text.pack(side='left', padx=4, pady=2)
+            self._progress.start()
 
-    def save(self):
-        for i, panel in enumerate(self.panels):
-            chara = panel.character
-            if i > 0 and panel.dirty:
-                self.save_data.replace(i, chara)
 
-        if self.filename == self.out_filename:
-            # create backup
-            path = Path(self.filename).resolve()
-            backup = path.parent / (path.stem + '.old.dat')
-            shutil.copy(self.filename, backup)
+    def _create_panel(self, parent, index):
+        return CharacterPanel(self, parent, self.characters[index])
 
-        self.save_data.save(self.out_filename)
+
+    def _show_panel(self, panel, index):
+        panel.show(self.characters[index])
+
+
+    def _hide_panel(self, panel):
+        # edits are kept in the character while its panel is reused. A
+        # panel with a value which is not a number is kept, and scrolled
+        # back to, until it is fixed.
+        try:
+            panel.commit()
+        except ValueError:
+            self.root.bell()
+            return False
+
+
+    def _panel_kind(self, index):
+        # characters which have the same widgets
+        chara = self.characters[index]
+        if chara.sex != 1:
+            return chara.sex
+        return (chara.sex, tuple(chara.answers), tuple(chara.denials), tuple(chara.attributes))
+
+
+    def save(self):
+        # worker thread, the widgets are committed before
+        try:
+            if self.filename == self.out_filename:
+                # create backup
+                path = Path(self.filename).resolve()
+                backup = path.parent / (path.stem + '.old.dat')
+                shutil.copy(self.filename, backup)
+
+            self.save_data.save(self.out_filename, patch=True)
+            self._events.put(('saved',))
+        except Exception:
+            self._events.put(('error', traceback.format_exc()))
 
 
     def save_and_quit(self, *args):
-        self.save()
-        self.root.destroy()
+        if self.save_data is None:
+            return
+        for index, panel in self.character_list.widgets():
+            try:
+                panel.commit()
+            except ValueError:
+                self.root.bell()
+                self.character_list.see(index)
+                return
+        self._save_btn.config(state='disabled')
+        self._show_progress(f'Saving {Path(self.out_filename).name}')
+        # the window is closed once the save is done, see _poll_events().
+        # Not a daemon, so quitting meanwhile still lets it finish.
+        threading.Thread(target=self.save).start()
 
     def quit(self, *args):
         self.root.destroy()
@@ -450,6 +749,8 @@ def get_default_chara_folder():
     return data+'UserData\chara'
 
 if __name__ == '__main__':
+    # the card index is scanned in processes, also in the frozen exe
+    multiprocessing.freeze_support()
     try:
         main()
     except Exception as e:
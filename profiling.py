@@ -0,0 +1,135 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from character import KoikatuCharacter
+from save_data import KoikatuSaveData
+
+# (class, method, stage name, how the processed bytes are counted)
+#   'data'   : length of the first argument
+#   'result' : length of the return value
+#   'stream' : bytes the method moves the stream (first argument) by
+STAGES = [
+    (KoikatuSaveData, '_find_characters', 'find characters', 'data'),
+    (KoikatuCharacter, '_read_png', 'read png', 'result'),
+    (KoikatuCharacter, '_read_list_info', 'read list_info', 'data'),
+    (KoikatuCharacter, '_read_custom', 'read Custom', 'data'),
+    (KoikatuCharacter, '_read_coordinate', 'read Coordinate', 'data'),
+    (KoikatuCharacter, '_read_parameter', 'read Parameter', 'data'),
+    (KoikatuCharacter, '_read_status', 'read Status', 'data'),
+    (KoikatuCharacter, '_read_kkex', 'read KKEx', 'data'),
+    (KoikatuCharacter, '_read_additional', 'read additional', 'stream'),
+    (KoikatuCharacter, '_pack_custom', 'pack Custom', 'result'),
+    (KoikatuCharacter, '_pack_coordinate', 'pack Coordinate', 'result'),
+    (KoikatuCharacter, '_pack_parameter', 'pack Parameter', 'result'),
+    (KoikatuCharacter, '_pack_status', 'pack Status', 'result'),
+    (KoikatuCharacter, '_pack_kkex', 'pack KKEx', 'result'),
+    (KoikatuCharacter, '_pack_additional', 'pack additional', 'result'),
+    (KoikatuSaveData, '_write', 'write save', 'stream'),
+]
+
+
+class Stats:
+    u"""calls, wall time and bytes processed per stage"""
+    def __init__(self):
+        self.stages = {}
+
+
+    def add(self, stage, seconds, size):
+        calls, total, nbytes = self.stages.get(stage, (0, 0.0, 0))
+        self.stages[stage] = (calls + 1, total + seconds, nbytes + size)
+
+
+    def clear(self):
+        self.stages.clear()
+
+
+    def report(self):
+        lines = [f'{"stage":18} {"calls":>7} {"time":>10} {"MB":>9} {"MB/s":>9}']
+        for stage, (calls, total, nbytes) in self.stages.items():
+            rate = nbytes / 2**20 / total if total > 0 else 0.0
+            lines.append(f'{stage:18} {calls:7} {total * 1000:8.1f}ms'
+                         f' {nbytes / 2**20:9.2f} {rate:9.1f}')
+        return '\n'.join(lines)
+
+
+_active = None
+
+
+@contextmanager
+def profile(stats=None):
+    u"""record the stages of loading and saving while the block runs
+
+    The methods listed in STAGES are replaced by timing wrappers only inside
+    the block, so nothing is measured (or slowed down) outside of it.
+    Characters decoded in worker processes are not recorded.
+
+        with profile() as stats:
+            save_data = KoikatuSaveData(filename)
+        print(stats.report())
+    """
+    global _active
+    if _active is not None:
+        raise RuntimeError('profile() is already active')
+    if stats is None:
+        stats = Stats()
+
+    originals = []
+    for cls, name, stage, size in STAGES:
+        func = cls.__dict__[name]
+        originals.append((cls, name, func))
+        setattr(cls, name, _timed(func, stage, size, stats))
+    _active = stats
+    try:
+        yield stats
+    finally:
+        for cls, name, func in originals:
+            setattr(cls, name, func)
+        _active = None
+
+
+def _timed(func, stage, size, stats):
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        if size == 'stream':
+            pos = args[0].tell()
+        start = time.perf_counter()
+        result = func(self, *args)
+        elapsed = time.perf_counter() - start
+        if size == 'data':
+            nbytes = len(args[0])
+        elif size == 'result':
+            nbytes = len(result)
+        else:
+            nbytes = args[0].tell() - pos
+        stats.add(stage, elapsed, nbytes)
+        return result
+    return wrapper
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_data')
+    parser.add_argument('--mmap', action='store_true',
+                        help='map the save file instead of reading it')
+    parser.add_argument('--lazy', action='store_true',
+                        help='decode character blocks on first access')
+    parser.add_argument('--reencode', action='store_true',
+                        help='re-encode every character when saving')
+
+    args = parser.parse_args()
+
+    with profile() as stats:
+        save_data = KoikatuSaveData(args.save_data, args.mmap, args.lazy)
+        if args.reencode:
+            for chara in save_data.characters:
+                chara.mark_dirty()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            save_data.save(os.path.join(tmpdir, 'out.dat'))
+        save_data.close()
+
+    print(stats.report())
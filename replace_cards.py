@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from character import KoikatuCharacter
+from save_data import KoikatuSaveData
+
+
+def load_card(path):
+    u"""the card at path, ValueError if the file is not a character card"""
+    with open(path, 'rb') as infile:
+        try:
+            return KoikatuCharacter(infile, True, lazy=True)
+        except Exception as e:
+            # e.g. struct.error of a plain PNG, AssertionError of other files
+            raise ValueError(f'{path}: not a character card') from e
+
+
+def load_cards(paths, workers=None):
+    u"""{path: card} of the card files, each parsed once, in parallel"""
+    paths = list(dict.fromkeys(paths))
+    if workers == 1 or len(paths) < 2:
+        return {path: load_card(path) for path in paths}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(load_card, paths)))
+
+
+def replace_cards(save_data, mapping, workers=None):
+    u"""replace the characters at the seats of mapping {seat: card path}
+
+    The character keeps its place, status and relations in the save, and
+    takes appearance, outfits, parameter and portrait of the card.
+    """
+    characters = save_data.characters
+    for seat in mapping:
+        if not 0 <= seat < len(characters):
+            raise ValueError(f'no character at seat {seat}')
+
+    cards = load_cards(mapping.values(), workers)
+    for seat, path in mapping.items():
+        chara = characters[seat]
+        card = cards[path]
+        # the status data of a character depends on its sex
+        if card.sex != chara.sex:
+            raise ValueError(f'{path}: card of sex {card.sex} for seat {seat} of sex {chara.sex}')
+    for seat, path in mapping.items():
+        characters[seat].replace_card(cards[path])
+    return len(mapping)
+
+
+def parse_mapping(items):
+    u"""{seat: path} from SEAT=PATH strings"""
+    mapping = {}
+    for item in items:
+        seat, sep, path = item.partition('=')
+        if not sep or not seat.strip().isdigit():
+            raise ValueError(f'expected SEAT=PATH: {item}')
+        mapping[int(seat)] = path.strip()
+    return mapping
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replace characters of a save by cards')
+    parser.add_argument('save_data')
+    parser.add_argument('cards', nargs='*', metavar='SEAT=PATH',
+                        help='seat number in the save (0 is the player) and card file')
+    parser.add_argument('-f', '--file', help='file with a SEAT=PATH line per card')
+    parser.add_argument('-o', dest='output', help='output file (default: overwrite save_data)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='parse the cards in this many processes')
+
+    # the options may come after the SEAT=PATH pairs
+    args = parser.parse_intermixed_args()
+
+    items = list(args.cards)
+    if args.file:
+        with open(args.file, encoding='utf-8') as file:
+            items += [line for line in file.read().splitlines()
+                      if line.strip() and not line.startswith('#')]
+    try:
+        mapping = parse_mapping(items)
+        save_data = KoikatuSaveData(args.save_data, lazy=True)
+        count = replace_cards(save_data, mapping, args.workers)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    save_data.save(args.output or args.save_data)
+    print(f'replaced {count} characters')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,51 +1,179 @@
 #!/usr/bin/env python
 import argparse
-import io
+import errno
+import mmap
 import os
 import struct
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from character import KoikatuCharacter
+from binary import BYTE, INT, LONG, BufferReader, atomic_write, write_buffers
+from character import FIELD_CODECS, KoikatuCharacter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 CHARA_HEADER = b'\x64\x00\x00\x00\x12\xe3\x80\x90KoiKatuChara\xe3\x80\x91'
 CHARA_SEPARATOR = b'\xff' * 8
 
+
+def _additional_offset(buffer, pos):
+    u"""offset of the additional data of the character starting at pos
+
+    Walks the length fields of the card (version, png, list info, chara data,
+    KKEx) without reading their contents. The additional data itself has no
+    length field. Returns None if the buffer ends before that offset.
+    """
+    try:
+        p = pos + len(CHARA_HEADER)
+        p += 1 + buffer[p]                              # version
+        p += 4 + INT.unpack_from(buffer, p)[0]          # png
+        p += 4 + INT.unpack_from(buffer, p)[0]          # list info
+        p += 8 + LONG.unpack_from(buffer, p)[0]         # chara data
+        if buffer[p] == 4 and buffer[p + 1:p + 5] == b'KKEx':
+            p += 9
+            p += 4 + INT.unpack_from(buffer, p)[0]
+        p += 8                                          # unknown02, mark
+        p += 1 + buffer[p]                              # dearname
+        p += 28                                         # feeling ... ero
+    except (IndexError, struct.error):
+        return None
+    return p if pos < p <= len(buffer) else None
+
+
 class KoikatuSaveData:
-    def __init__(self, filename):
+    u"""a save file and its characters
+
+    With use_mmap the file is mapped rather than read, and the characters
+    keep views of the mapping (png, chara_data) instead of copies. Those
+    have to be released, or copied with bytes(), before save() over the
+    loaded file or close(), which fail with BufferError otherwise.
+    """
+    def __init__(self, filename, use_mmap=False, lazy=False, workers=None, progress=None):
         self.filename = filename
+        self.lazy = lazy
+        # decode characters in this many processes
+        self.workers = workers
+        # called with (character, count, total) for each decoded character
+        self.progress = progress
+        self._mmap = None
         with open(filename, 'rb') as file:
-            self._load(file)
-
-
-    def _load(self, file):
+            stat = os.fstat(file.fileno())
+            if use_mmap:
+                # characters keep memoryview slices of the mapping,
+                # so it stays open until close() or save() over it
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                buffer = self._mmap
+            else:
+                # writable, so that patch() can update it with the file
+                buffer = bytearray(stat.st_size)
+                file.readinto(buffer)
+        self._buffer = buffer
+        # what patch() can overwrite in place: the file as it was loaded
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        self._load(buffer)
+        self._loaded = (list(self.characters), b''.join(self._header()))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        if self._mmap is None:
+            return
+        detached = [chara._detach() for chara in self.characters]
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a view of the mapping is held elsewhere, the characters take
+            # theirs back so that nothing changed
+            view = memoryview(self._mmap)
+            for chara, names in zip(self.characters, detached):
+                chara._attach_views(view, names)
+            raise BufferError(f'{self.filename} is mapped and views of it are still held, '
+                              'release them or copy them with bytes() first') from None
+        self._mmap = None
+        self._buffer = None
+        self._stat = None
+
+
+    def _load(self, buffer):
+        file = BufferReader(buffer)
         self.version_length = file.read(1)
         self.b_version = file.read(int.from_bytes(self.version_length, byteorder='big'))
         self.version_num = self.b_version.decode("utf-8")
         self.school = self._read_utf8_string(file)
 
         self.b_unknown02 = file.read(17)
-        # split character data
-        chara_part = file.read()
-        chara_data = chara_part.split(CHARA_HEADER)
+
+        spans = self._find_characters(buffer, file.tell())
+        if self.workers and len(spans) > 1:
+            self.characters = self._load_parallel(file.buffer, spans)
+            return
 
         self.characters = []
         count = 0
-        for data in chara_data:
-            if data:
-                chara = KoikatuCharacter(io.BytesIO(CHARA_HEADER + data), False, count == 0,self.version_num)
-                self.characters.append(chara)
-                count += 1
-                #print(f'chara: {chara.lastname} {chara.firstname} ({chara.nickname})')
+        for start, end in spans:
+            data = BufferReader(file.buffer[start:end], start)
+            chara = KoikatuCharacter(data, False, count == 0, self.version_num, self.lazy)
+            self.characters.append(chara)
+            count += 1
+            if self.progress is not None:
+                self.progress(chara, count, len(spans))
+            #print(f'chara: {chara.lastname} {chara.firstname} ({chara.nickname})')
+
+
+    def _load_parallel(self, view, spans):
+        # the workers read their characters from the file themselves,
+        # rather than getting a copy of the buffer
+        tasks = [(self.filename, self._stat, start, end, i == 0, self.version_num, self.lazy)
+                 for i, (start, end) in enumerate(spans)]
+        chunksize = max(1, len(tasks) // (self.workers * 4))
+        characters = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(_decode_character, tasks, chunksize=chunksize)
+            for chara, (start, end) in zip(results, spans):
+                # the characters come back without their bytes, which are
+                # taken from the buffer of this process instead
+                chara._attach_views(view)
+                chara._raw = view[start:end]
+                characters.append(chara)
+                if self.progress is not None:
+                    self.progress(chara, len(characters), len(spans))
+        return characters
+
+
+    def _find_characters(self, buffer, pos):
+        # (start, end) of each character, without copying the payload.
+        # Only the short additional tail is searched for the next header,
+        # so header bytes inside PNG or KKEx data are never matched.
+        spans = []
+        pos = buffer.find(CHARA_HEADER, pos)
+        while pos != -1:
+            tail = _additional_offset(buffer, pos)
+            if tail is None:
+                tail = pos + len(CHARA_HEADER)
+            end = buffer.find(CHARA_HEADER, tail)
+            spans.append((pos, len(buffer) if end == -1 else end))
+            pos = end
+        return spans
 
 
     def _read_utf8_string(self, file):
-        len_ = struct.unpack('b', file.read(1))[0]
+        len_ = file.unpack(BYTE)[0]
         value = file.read(len_)
         return (value.decode('utf8'), len_)
 
 
     def _pack_utf8_string(self, string):
-        len_ = struct.pack('b', string[1])
+        len_ = BYTE.pack(string[1])
         binary = string[0].encode()
         return len_ + binary
 
@@ -54,33 +182,256 @@ class KoikatuSaveData:
         self.characters[pos] = character
 
 
-    def save(self, filename):
-        with open(filename, 'wb') as out:
-            out.write(self.version_length)
-            out.write(self.b_version)
-            out.write(self._pack_utf8_string(self.school))
-            out.write(self.b_unknown02)
-            for chara in self.characters:
-                chara.save(out)
-
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('save_data')
-
-    args = parser.parse_args()
-
-    # load save data
-    save_data = KoikatuSaveData(args.save_data)
-
-    print('school: ', save_data.school[0])
-
-    # extract character data
-    outdir = Path('cards')
+    def get_column(self, name, default=-1):
+        u"""a field of every character, as a NumPy array if numpy is installed
+
+        name is an attribute such as 'feeling' or 'personality', 'ac.<key>'
+        for an ac level or 'additional.<key>' for a counter. default is used
+        for characters without that field.
+        """
+        values = [_get_field(chara, name, default) for chara in self.characters]
+        if numpy is not None:
+            return numpy.array(values)
+        return values
+
+
+    def set_column(self, name, values, where=None):
+        self.set_columns({name: values}, where)
+
+
+    def set_columns(self, columns, where=None):
+        u"""set fixed-width fields of many characters in one pass
+
+        columns maps field names (see get_column()) to one value for every
+        character, or a single value for all of them. Only the characters
+        selected by the booleans in where are changed, and only the fields
+        they have in the file, so save(patch=True) can write them in place.
+        """
+        count = len(self.characters)
+        # the caller's columns are left as they are
+        lists = {}
+        for name, values in columns.items():
+            if not (name.startswith('ac.') or name.startswith('additional.')
+                    or name in FIELD_CODECS):
+                raise ValueError(f'{name} is not a fixed-width field')
+            scalar = isinstance(values, (int, float))
+            if numpy is not None:
+                scalar = scalar or isinstance(values, numpy.generic)
+            if scalar:
+                values = [values] * count
+            lists[name] = values = list(values)
+            if len(values) != count:
+                raise ValueError(f'{len(values)} values of {name} for {count} characters')
+        where = [True] * count if where is None else list(where)
+        if len(where) != count:
+            raise ValueError(f'{len(where)} values of where for {count} characters')
+
+        for i, chara in enumerate(self.characters):
+            if not where[i]:
+                continue
+            for name, values in lists.items():
+                _set_field(chara, name, int(values[i]))
+
+
+    def save(self, filename, patch=False):
+        u"""write the save data atomically
+
+        The data is written to a temporary file next to filename, which then
+        replaces it, so a crash while writing leaves the old file intact.
+        With patch, only the changed fields are overwritten if that is
+        possible, see patch().
+        """
+        if patch and self.patch(filename):
+            return
+        buffers = self._buffers()
+        size = sum(len(buffer) for buffer in buffers)
+
+        with atomic_write(filename, fsync=True) as out:
+            if hasattr(os, 'posix_fallocate'):
+                # fail early if the disk is full
+                try:
+                    os.posix_fallocate(out.fileno(), 0, size)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        raise
+            self._write(out, buffers)
+            del buffers
+            if self._mmap is not None and self._is_source(filename):
+                # the mapping has to be released before the file is replaced
+                self.close()
+        if self._is_source(filename):
+            # the offsets of the loaded file are no longer valid
+            self._stat = None
+
+
+    def patch(self, filename=None):
+        u"""overwrite the changed fixed-width fields in the loaded file
+
+        Only possible if filename is the loaded file, it was not modified
+        since, and all changes are to fixed-width fields (status, ac and
+        additional values). Returns False if the file is left untouched
+        and has to be saved with save().
+        """
+        filename = filename or self.filename
+        patches = self._patches(filename)
+        if patches is None:
+            return False
+
+        if patches:
+            with open(filename, 'r+b') as out:
+                for offset, value in patches:
+                    out.seek(offset)
+                    out.write(value)
+                out.flush()
+                os.fsync(out.fileno())
+                stat = os.fstat(out.fileno())
+            self._stat = (stat.st_size, stat.st_mtime_ns)
+            if self._mmap is None:
+                # the characters keep views of this buffer as their bytes,
+                # the mapping already shows what is written to the file
+                for offset, value in patches:
+                    self._buffer[offset:offset + len(value)] = value
+        for chara in self.characters:
+            chara._clear_changes()
+        return True
+
+
+    def _patches(self, filename):
+        # (offset, bytes) to write into filename, or None if not possible
+        if self._stat is None or not self._is_source(filename):
+            return None
+        stat = os.stat(filename)
+        if (stat.st_size, stat.st_mtime_ns) != self._stat:
+            return None
+        characters, header = self._loaded
+        if self.characters != characters or b''.join(self._header()) != header:
+            return None
+        patches = []
+        for chara in self.characters:
+            chara_patches = chara._patches()
+            if chara_patches is None:
+                return None
+            patches += chara_patches
+        return sorted(patches)
+
+
+    def _is_source(self, filename):
+        return os.path.exists(filename) and os.path.samefile(filename, self.filename)
+
+
+    def _header(self):
+        return [
+            self.version_length,
+            self.b_version,
+            self._pack_utf8_string(self.school),
+            self.b_unknown02,
+        ]
+
+
+    def _buffers(self):
+        # every part of the file, the unchanged characters as their
+        # original bytes (views into the mapping in mmap mode)
+        buffers = self._header()
+        buffers += [chara._dump() for chara in self.characters]
+        return buffers
+
+
+    def _write(self, out, buffers):
+        write_buffers(out, buffers)
+
+
+def _get_field(chara, name, default):
+    if name.startswith('ac.'):
+        key = name[len('ac.'):]
+        return chara.get_ac(key) if len(chara.ac.get(key, b'')) > 0 else default
+    if name.startswith('additional.'):
+        return chara.additional.get(name[len('additional.'):], default)
+    return getattr(chara, name, default)
+
+
+def _set_field(chara, name, value):
+    # only fields in the file, e.g. no date for the player
+    if name not in chara._offsets:
+        return
+    if name.startswith('ac.'):
+        chara.set_ac(name[len('ac.'):], min(max(value, 0), 10))
+    elif name.startswith('additional.'):
+        chara.set_additional(name[len('additional.'):], value)
+    else:
+        setattr(chara, name, value)
+
+
+def _decode_character(task):
+    filename, stat, start, end, skip_additional, version_num, lazy = task
+    with open(filename, 'rb') as file:
+        info = os.fstat(file.fileno())
+        if (info.st_size, info.st_mtime_ns) != stat:
+            raise OSError(f'{filename} changed while it was loaded')
+        file.seek(start)
+        data = file.read(end - start)
+    chara = KoikatuCharacter(BufferReader(data, start), False, skip_additional, version_num, lazy)
+    chara._strip_views()
+    return chara
+
+
+def iter_characters(filename, lazy=False, chunk_size=1024 * 1024):
+    u"""yield the characters of a save file one by one
+
+    The file is read in chunks and only the bytes of the current character
+    are kept, so memory use does not grow with the number of characters.
+    """
+    with open(filename, 'rb') as file:
+        version_length = file.read(1)[0]
+        version_num = file.read(version_length).decode('utf-8')
+        school_length = BYTE.unpack(file.read(1))[0]
+        file.seek(school_length + 17, 1)
+
+        buffer = bytearray()
+        # file offset of buffer[0]
+        base = file.tell()
+        started = False
+        scanned = 0
+        count = 0
+        while True:
+            chunk = file.read(chunk_size)
+            buffer += chunk
+            while True:
+                if started:
+                    tail = _additional_offset(buffer, 0)
+                    if tail is None and chunk:
+                        # read on until the length fields are complete
+                        break
+                    scanned = max(scanned, tail or 1)
+                pos = buffer.find(CHARA_HEADER, scanned)
+                if pos == -1:
+                    # the next header may begin in the last bytes read
+                    scanned = max(int(started), len(buffer) - len(CHARA_HEADER) + 1)
+                    break
+                if started:
+                    data = BufferReader(bytes(buffer[:pos]), base)
+                    yield KoikatuCharacter(data, False, count == 0, version_num, lazy)
+                    count += 1
+                # anything before the first header is dropped
+                del buffer[:pos]
+                base += pos
+                started = True
+                scanned = 1
+
+            if not chunk:
+                if started and buffer:
+                    data = BufferReader(bytes(buffer), base)
+                    yield KoikatuCharacter(data, False, count == 0, version_num, lazy)
+                return
+
+
+def dump_characters(characters, outdir):
+    u"""write png, chara data and additional data of each character"""
+    outdir = Path(outdir)
     if not outdir.exists():
         os.makedirs(outdir)
 
-    for i, chara in enumerate(save_data.characters):
+    count = 0
+    for i, chara in enumerate(characters):
         with open(outdir / f'char_{i:03}.png', 'wb') as pngfile:
             pngfile.write(chara.png)
 
@@ -96,7 +447,29 @@ if __name__ == '__main__':
 
         with open(outdir / f'char_{i:03}.additional2.dat', 'wb') as outfile:
             outfile.write(chara.after_additional)
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('save_data')
+    parser.add_argument('--mmap', action='store_true',
+                        help='map the save file instead of reading it')
+    parser.add_argument('--lazy', action='store_true',
+                        help='decode character blocks on first access')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='decode characters in this many processes')
+
+    args = parser.parse_args()
+
+    # load save data
+    save_data = KoikatuSaveData(args.save_data, args.mmap, args.lazy, args.workers)
+
+    print('school: ', save_data.school[0])
 
+    # extract character data
+    dump_characters(save_data.characters, 'cards')
 
     # confirm serializing
     save_data.save(args.save_data + '_01.dat')
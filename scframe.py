@@ -59,6 +59,119 @@ class VerticalScrolledFrame(ttk.Frame):
         self.canvas.yview_scroll(-1 * (1 if event.delta > 0 else -1), tk.UNITS)
 
 
+class VirtualScrolledList(ttk.Frame):
+    """A vertically scrolled grid of count items, with widgets only for the
+    visible rows. Widgets of rows scrolled out of view are reused:
+    * create(parent, index) makes a widget for an item
+    * show(widget, index) binds a widget to an item
+    * hide(widget) is called before a widget is reused for another item,
+      if it returns False the widget is kept and scrolled back to
+    * kind(index) tells which items can share a widget (all by default)
+    """
+    def __init__(self, parent, count, create, show, hide, kind=None,
+                 columns=1, row_height=100, column_width=100, *args, **kw):
+        ttk.Frame.__init__(self, parent, *args, **kw)
+        self.count = count
+        self.columns = columns
+        self.row_height = row_height
+        self.column_width = column_width
+        self._create = create
+        self._show = show
+        self._hide = hide
+        self._kind = kind or (lambda index: None)
+        # index -> (widget, canvas item, kind) of the visible items
+        self._cells = {}
+        # kind -> [(widget, canvas item)] which are not in use
+        self._free = {}
+
+        vscrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL)
+        vscrollbar.pack(fill=tk.Y, side=tk.RIGHT, expand=tk.FALSE)
+        canvas = tk.Canvas(self, bd=0, highlightthickness=0,
+                           yscrollcommand=vscrollbar.set,
+                           width=columns * column_width)
+        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=tk.TRUE)
+        self.canvas = canvas
+        vscrollbar.config(command=self.yview)
+
+        canvas.bind('<Configure>', lambda event: self.refresh())
+        # the wheel scrolls the list wherever the pointer is inside it
+        self.bind('<Enter>', lambda event: self.bind_all('<MouseWheel>', self.mouse_wheel_scroll))
+        self.bind('<Leave>', lambda event: self.unbind_all('<MouseWheel>'))
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def mouse_wheel_scroll(self, event):
+        self.yview('scroll', -1 * (1 if event.delta > 0 else -1), tk.UNITS)
+
+    def widgets(self):
+        """(index, widget) of the visible items"""
+        return [(index, cell[0]) for index, cell in sorted(self._cells.items())]
+
+    def refresh(self):
+        rows = (self.count + self.columns - 1) // self.columns
+        self.canvas.config(scrollregion=(0, 0, self.columns * self.column_width,
+                                         rows * self.row_height),
+                           yscrollincrement=self.row_height // 4)
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = int(top // self.row_height) * self.columns
+        last = min(self.count, (int(bottom // self.row_height) + 1) * self.columns)
+        visible = range(first, last)
+
+        kept = None
+        for index in [i for i in self._cells if i not in visible]:
+            widget, item, kind = self._cells[index]
+            if self._hide(widget) is False:
+                kept = index
+                continue
+            del self._cells[index]
+            # out of sight until it is reused
+            self.canvas.coords(item, -10000, -10000)
+            self._free.setdefault(kind, []).append((widget, item))
+
+        for index in visible:
+            if index in self._cells:
+                continue
+            x = (index % self.columns) * self.column_width
+            y = (index // self.columns) * self.row_height
+            kind = self._kind(index)
+            free = self._free.get(kind)
+            if free:
+                widget, item = free.pop()
+                self.canvas.coords(item, x, y)
+            else:
+                widget = self._create(self.canvas, index)
+                item = self.canvas.create_window(x, y, window=widget, anchor=tk.NW)
+            self._show(widget, index)
+            self._cells[index] = (widget, item, kind)
+
+        # grow the cells to fit the widgets, then lay them out again
+        widgets = [cell[0] for cell in self._cells.values()]
+        if widgets:
+            self.update_idletasks()
+            width = max(w.winfo_reqwidth() for w in widgets)
+            height = max(w.winfo_reqheight() for w in widgets)
+            if width > self.column_width or height > self.row_height:
+                self.column_width = max(width, self.column_width)
+                self.row_height = max(height, self.row_height)
+                self.canvas.config(width=self.columns * self.column_width)
+                for index, (widget, item, kind) in self._cells.items():
+                    self.canvas.coords(item, (index % self.columns) * self.column_width,
+                                       (index // self.columns) * self.row_height)
+                self.refresh()
+
+        if kept is not None:
+            # after this refresh, which may be part of a scroll
+            self.after_idle(self.see, kept)
+
+    def see(self, index):
+        """scroll so that the row of item index is at the top"""
+        rows = (self.count + self.columns - 1) // self.columns
+        self.yview('moveto', (index // self.columns) / max(rows, 1))
+
+
 if __name__ == "__main__":
 
     class SampleApp(tk.Tk):
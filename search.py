@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+import argparse
+import os
+import pickle
+import re
+import shlex
+import sys
+from array import array
+from pathlib import Path
+
+from batch import find_save_files
+from binary import atomic_write
+from resource import Resource as RM
+from save_data import iter_characters
+
+DEFAULT_PATH = Path.home() / '.cache' / 'KoikatuSaveDataEdit' / 'search.idx'
+
+NAME_FIELDS = ('lastname', 'firstname', 'nickname')
+# parameter dicts of boolean flags
+FLAG_GROUPS = ('attribute', 'awnser', 'denial')
+# small ranges of values, with a bitmap per value
+VALUE_FIELDS = ('sex', 'personality', 'weakPoint', 'lover', 'koikatu', 'date')
+# wide ranges of values, stored per character and scanned
+RANGE_FIELDS = ('feeling', 'm_love', 'h_count', 'intimacy')
+
+ALIASES = {
+    'answer': 'awnser',
+    'weak_point': 'weakPoint',
+    'relation': 'lover',
+    'club': 'koikatu',
+}
+
+# resource lists with the names of the values, e.g. personality=ヤンデレ
+VALUE_NAMES = {
+    'personality': 'personalities',
+    'weakPoint': 'weak_points',
+    'lover': 'relations',
+    'koikatu': 'koikatu',
+    'date': 'dates',
+}
+
+TERM = re.compile(r'^([\w.]+)(<=|>=|!=|=|<|>)(.+)$')
+
+
+def _grams(text):
+    # characters and pairs of characters, names are often 2 or 3 kanji
+    text = text.lower()
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _ids(bitmap):
+    # positions of the set bits
+    return [i for i, bit in enumerate(bin(bitmap)[:1:-1]) if bit == '1']
+
+
+class SearchIndex:
+    u"""inverted index of the names and bitmap indexes of the flags and
+    values of the characters of many saves
+
+    Bitmaps are ints with a bit per character (doc). update() reindexes only
+    saves whose size or mtime changed, and the doc ids of removed saves are
+    reused, which keeps the bitmaps short.
+    """
+    VERSION = 1
+
+    def __init__(self):
+        self.version = self.VERSION
+        # path -> (size, mtime_ns, doc ids)
+        self.files = {}
+        # doc id -> (path, number, lastname, firstname, nickname), None if free
+        self.docs = []
+        self.free = []
+        self.live = 0
+        self.names = {}
+        self.flags = {}
+        self.values = {}
+        self.ranges = {name: array('q') for name in RANGE_FIELDS}
+
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            state = pickle.load(file)
+        if not isinstance(state, dict) or state.get('version') != cls.VERSION:
+            raise ValueError(f'{path}: index of another version')
+        index = cls()
+        index.__dict__.update(state)
+        return index
+
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path) as out:
+            # the attributes only, the class may be __main__.SearchIndex
+            pickle.dump(vars(self), out, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def update(self, paths):
+        u"""index new and changed saves, drop saves which no longer exist
+
+        Returns the number of saves (re)indexed and [(path, error)] of the
+        saves which could not be read; those are left out of the index and
+        do not stop the others.
+        """
+        count = 0
+        errors = []
+        for path in [p for p in self.files if not os.path.exists(p)]:
+            self.remove(path)
+        for path in paths:
+            path = str(Path(path).resolve())
+            ids = []
+            try:
+                stat = os.stat(path)
+                known = self.files.get(path)
+                if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                self.remove(path)
+                for number, chara in enumerate(iter_characters(path, lazy=True)):
+                    ids.append(self._add(path, number, chara))
+            except Exception as e:
+                # drop the characters added before the error
+                self.files[path] = (None, None, ids)
+                self.remove(path)
+                errors.append((path, e))
+                continue
+            self.files[path] = (stat.st_size, stat.st_mtime_ns, ids)
+            count += 1
+        return count, errors
+
+
+    def remove(self, path):
+        if path not in self.files:
+            return
+        ids = self.files.pop(path)[2]
+        mask = 0
+        grams = set()
+        for doc in ids:
+            mask |= 1 << doc
+            for name in self.docs[doc][2:]:
+                grams |= _grams(name)
+            self.docs[doc] = None
+            self.free.append(doc)
+        mask = ~mask
+        self.live &= mask
+        for gram in grams:
+            self.names[gram] &= mask
+            if not self.names[gram]:
+                del self.names[gram]
+        for bitmaps in (self.flags, self.values):
+            for key in bitmaps:
+                bitmaps[key] &= mask
+
+
+    def _add(self, path, number, chara):
+        doc = self.free.pop() if self.free else len(self.docs)
+        bit = 1 << doc
+        names = tuple(str(getattr(chara, name)) for name in NAME_FIELDS)
+        if doc == len(self.docs):
+            self.docs.append(None)
+            for values in self.ranges.values():
+                values.append(-1)
+        self.docs[doc] = (path, number) + names
+        self.live |= bit
+
+        for name in names:
+            for gram in _grams(name):
+                self.names[gram] = self.names.get(gram, 0) | bit
+        parameter = chara.parameter
+        for group in FLAG_GROUPS:
+            for key, value in parameter.get(group, {}).items():
+                if value:
+                    key = f'{group}.{key}'
+                    self.flags[key] = self.flags.get(key, 0) | bit
+        for name in VALUE_FIELDS:
+            value = parameter.get(name) if name in parameter else getattr(chara, name, None)
+            if isinstance(value, int):
+                key = (name, int(value))
+                self.values[key] = self.values.get(key, 0) | bit
+        for name, values in self.ranges.items():
+            values[doc] = int(getattr(chara, name, -1))
+        return doc
+
+
+    def search(self, query):
+        u"""(path, number, lastname, firstname, nickname) of the characters
+        matching all terms of the query
+
+        A term is a name (or part of one), a flag such as attribute.choroi,
+        or a comparison such as personality=3, lover=1 or feeling>=50.
+        Value names of the resources work too (personality=ヤンデレ).
+        A leading '-' negates a term.
+        """
+        result = self.live
+        for term in shlex.split(query):
+            negate = term.startswith('-')
+            if negate:
+                term = term[1:]
+            bitmap = self._match(term, result)
+            result = result & ~bitmap if negate else result & bitmap
+        return [self.docs[doc] for doc in _ids(result)]
+
+
+    def _match(self, term, candidates):
+        m = TERM.match(term)
+        if m is None:
+            field = self._field(term)
+            if '.' in field and field.split('.')[0] in FLAG_GROUPS:
+                return self.flags.get(field, 0)
+            return self._match_name(term[len('name:'):] if term.startswith('name:') else term)
+
+        field, op, value = self._field(m.group(1)), m.group(2), m.group(3)
+        value = self._value(field, value)
+        compare = {
+            '=': value.__eq__, '!=': value.__ne__,
+            '<': value.__gt__, '<=': value.__ge__,
+            '>': value.__lt__, '>=': value.__le__,
+        }[op]
+        if field in VALUE_FIELDS:
+            bitmap = 0
+            for (name, v), b in self.values.items():
+                if name == field and compare(v):
+                    bitmap |= b
+            return bitmap
+        if field in RANGE_FIELDS:
+            values = self.ranges[field]
+            bitmap = 0
+            for doc in _ids(candidates):
+                if values[doc] >= 0 and compare(values[doc]):
+                    bitmap |= 1 << doc
+            return bitmap
+        raise ValueError(f'unknown field {field}')
+
+
+    def _match_name(self, text):
+        bitmap = self.live
+        for gram in _grams(text):
+            bitmap &= self.names.get(gram, 0)
+        # the grams only narrow it down, 'ab' and 'ba' match 'aba' too
+        text = text.lower()
+        result = 0
+        for doc in _ids(bitmap):
+            if any(text in name.lower() for name in self.docs[doc][2:]):
+                result |= 1 << doc
+        return result
+
+
+    def _field(self, name):
+        group, dot, key = name.partition('.')
+        group = ALIASES.get(group, group)
+        return f'{group}.{key}' if dot else group
+
+
+    def _value(self, field, value):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        names = RM.res(VALUE_NAMES.get(field, ''))
+        if isinstance(names, list) and value in names:
+            return names.index(value)
+        raise ValueError(f'unknown value {value} of {field}')
+
+
+def main():
+    default_resource = Path(sys.argv[0]).parent / 'resources_ja.json'
+
+    parser = argparse.ArgumentParser(description='search the characters of many saves')
+    parser.add_argument('-i', '--index', default=DEFAULT_PATH, help='index file')
+    parser.add_argument('-r', dest='resources', default=default_resource,
+                        help='resource file name, for value names in queries')
+    sub = parser.add_subparsers(dest='command', required=True)
+    update = sub.add_parser('update', help='index new and changed saves')
+    update.add_argument('paths', nargs='+', help='save files, directories or glob patterns')
+    find = sub.add_parser('find', help='print the matching characters',
+                          description='negated terms have to follow --')
+    find.add_argument('query', nargs='+',
+                      help='e.g. name:ユイ "personality=ヤンデレ" lover=1 -attribute.choroi')
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.resources):
+        RM.load(args.resources)
+    try:
+        index = SearchIndex.load(args.index)
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+        index = SearchIndex()
+
+    if args.command == 'update':
+        count, errors = index.update(find_save_files(args.paths))
+        index.save(args.index)
+        for path, error in errors:
+            print(f'{path}: error: {error!r}', file=sys.stderr)
+        print(f'{count} saves indexed, {len(index.files)} saves in the index')
+        return 1 if errors else 0
+
+    try:
+        results = index.search(' '.join(shlex.quote(q) for q in args.query))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for path, number, lastname, firstname, nickname in results:
+        print(f'{path} {number:4} {lastname} {firstname} ({nickname})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
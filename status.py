@@ -101,6 +101,18 @@ class StatusPanel(ttk.Frame):
         cb.grid(row=row, column=3, sticky='W')
 
 
+    def update_character(self, chara):
+        self._feeling.set(f'{chara.feeling}')
+        self._relation.set(self._get_value(RM.res('relations'), chara.lover))
+        self._m_love.set(f'{chara.m_love}')
+        self._h_count.set(f'{chara.h_count}')
+        self._intimacy.set(f'{chara.intimacy}')
+        self._koikatu.set(self._get_value(RM.res('koikatu'), chara.koikatu))
+        self._date.set(self._get_value(RM.res('dates'), chara.date))
+        for name in self._ac:
+            self._ac[name].set(self._get_value(RM.res('ac'), chara.get_ac(name)))
+
+
     def _make_ac(self, chara, name):
         values = RM.res('ac')
         label = ttk.Label(self, text=RM.res(name))
@@ -0,0 +1,180 @@
+import hashlib
+import io
+import os
+import queue
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+from binary import atomic_write
+
+DEFAULT_DIR = Path.home() / '.cache' / 'KoikatuSaveDataEdit' / 'thumbnails'
+
+# largest size shown in a CharacterPanel, portraits in saves are 252x352
+THUMBNAIL_SIZE = (252, 352)
+
+# width and height before the raw RGBA pixels of a cached thumbnail
+HEADER = struct.Struct('<II')
+
+
+class ThumbnailCache:
+    u"""downscaled portraits, cached on disk and in a bounded LRU in memory
+
+    Thumbnails are keyed by a hash of the PNG. request() decodes them in a
+    thread pool, poll() (or attach() to a Tk root) calls the callbacks of
+    the finished ones on the calling thread, which Tk requires.
+    """
+    def __init__(self, cache_dir=DEFAULT_DIR, size=THUMBNAIL_SIZE,
+                 max_memory=64 * 1024 * 1024, max_disk=256 * 1024 * 1024, workers=4):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.size = size
+        self.max_memory = max_memory
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._done = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._executor.submit(self.prune, max_disk)
+
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+    def key(self, png):
+        w, h = self.size
+        return f'{hashlib.blake2b(png, digest_size=16).hexdigest()}_{w}x{h}'
+
+
+    def get(self, key):
+        u"""thumbnail from memory, or None"""
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+            return image
+
+
+    def load(self, png, key=None):
+        u"""thumbnail of a PNG, from memory, from disk or decoded"""
+        key = key or self.key(png)
+        image = self.get(key)
+        if image is not None:
+            return image
+        image = self._read(key)
+        if image is None:
+            image = Image.open(io.BytesIO(png))
+            image.thumbnail(self.size)
+            image = image.convert('RGBA')
+            self._write(key, image)
+        self._remember(key, image)
+        return image
+
+
+    def request(self, png, callback):
+        u"""call callback(key, image) with the thumbnail of png
+
+        Directly if it is in memory, otherwise from poll() once it is
+        loaded. Returns the key.
+        """
+        key = self.key(png)
+        image = self.get(key)
+        if image is not None:
+            callback(key, image)
+            return key
+
+        png = bytes(png)
+        def task():
+            try:
+                self._done.put((callback, key, self.load(png, key)))
+            except Exception as e:
+                self._done.put((callback, key, e))
+        self._executor.submit(task)
+        return key
+
+
+    def poll(self):
+        u"""call the callbacks of the loaded thumbnails"""
+        while True:
+            try:
+                callback, key, image = self._done.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(image, Exception):
+                # broken portrait, the placeholder stays
+                continue
+            callback(key, image)
+
+
+    def attach(self, root, interval=30):
+        u"""poll() from the Tk event loop of root"""
+        def _poll():
+            self.poll()
+            root.after(interval, _poll)
+        root.after(interval, _poll)
+
+
+    def prune(self, max_disk):
+        u"""remove the least recently used thumbnails beyond max_disk bytes"""
+        files = []
+        for path in self.cache_dir.glob('*.rgba'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort(reverse=True)
+        total = 0
+        for _, size, path in files:
+            total += size
+            if total > max_disk:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+
+    def _remember(self, key, image):
+        nbytes = image.width * image.height * 4
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = image
+            self._memory_size += nbytes
+            while self._memory_size > self.max_memory and len(self._memory) > 1:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= old.width * old.height * 4
+
+
+    def _read(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            path = self.cache_dir / f'{key}.rgba'
+            with open(path, 'rb') as file:
+                data = file.read()
+            # the mtime orders the files for prune()
+            os.utime(path)
+            width, height = HEADER.unpack_from(data)
+            return Image.frombuffer('RGBA', (width, height), data[HEADER.size:],
+                                    'raw', 'RGBA', 0, 1)
+        except (OSError, struct.error, ValueError):
+            return None
+
+
+    def _write(self, key, image):
+        if self.cache_dir is None:
+            return
+        # other threads (or instances) may write the same key
+        try:
+            with atomic_write(self.cache_dir / f'{key}.rgba') as out:
+                out.write(HEADER.pack(image.width, image.height))
+                out.write(image.tobytes())
+        except OSError:
+            pass